@@ -1,7 +1,17 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+import asyncio
 import secrets
+import time
+
+from config import (
+    TOKEN_CACHE_SIZE, ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM,
+    HASH_WORKERS, HASH_QUEUE_SIZE
+)
 
 # Секретный ключ для JWT
 SECRET_KEY = "your-secret-key-here-change-in-production"
@@ -11,15 +21,43 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 дней
 # Используем argon2 вместо bcrypt (нет ограничения на длину пароля)
 pwd_context = CryptContext(
     schemes=["argon2"],
-    deprecated="auto"
+    deprecated="auto",
+    argon2__time_cost=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM
 )
 
+# argon2 отпускает GIL, поэтому хватает пула потоков
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='argon2')
+_hash_pending = 0
+
+class HashingBusy(Exception):
+    """Пул хеширования паролей переполнен"""
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def _run_hashing(fn, *args):
+    """Выполнить хеширование в пуле; HashingBusy, если очередь заполнена"""
+    global _hash_pending
+    if _hash_pending >= HASH_WORKERS + HASH_QUEUE_SIZE:
+        raise HashingBusy()
+    
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, fn, *args)
+    finally:
+        _hash_pending -= 1
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_hashing(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hashing(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -35,4 +73,30 @@ def verify_token(token: str):
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+
+# LRU-кэш проверенных токенов: token -> (payload, exp)
+_verified_tokens: OrderedDict = OrderedDict()
+
+def verify_token_cached(token: str) -> Optional[dict]:
+    """verify_token с кэшем: повторная проверка того же токена до его exp без HMAC"""
+    cached = _verified_tokens.get(token)
+    if cached:
+        if cached[1] > time.time():
+            _verified_tokens.move_to_end(token)
+            return cached[0]
+        del _verified_tokens[token]
+    
+    payload = verify_token(token)
+    if not payload or 'exp' not in payload:
+        return payload
+    
+    # Истекшие токены не используются и сами уходят из хвоста LRU
+    if len(_verified_tokens) >= TOKEN_CACHE_SIZE:
+        _verified_tokens.popitem(last=False)
+    _verified_tokens[token] = (payload, payload['exp'])
+    return payload
+
+def token_claims(user: dict) -> dict:
+    """Данные пользователя, которые кладутся в токен при входе"""
+    return {"sub": str(user['id']), "gender": user['gender'], "age": user['age']}
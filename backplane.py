@@ -0,0 +1,244 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional, Set
+from urllib.parse import urlparse
+
+from config import BACKPLANE_TIMEOUT
+from frames import dumps, loads
+
+# Обработчик входящих сообщений: handler(channel, message)
+Handler = Callable[[str, dict], Awaitable[None]]
+
+# Продление блокировки только ее владельцем (атомарно на сервере)
+RENEW_SCRIPT = (
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+)
+# Паузы между попытками переподключения (секунды)
+RECONNECT_DELAY_START = 0.1
+RECONNECT_DELAY_MAX = 5.0
+
+
+class BackplaneUnavailable(ConnectionError):
+    """Шина недоступна: команда не отправлена или ответ не пришел вовремя"""
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class Backplane:
+    """Шина сообщений между воркерами: pub/sub по каналам и блокировка с TTL"""
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self.channels: Set[str] = set()
+
+    async def start(self, handler: Handler):
+        self._handler = handler
+
+    async def close(self):
+        pass
+
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def try_acquire(self, key: str, owner: str, ttl_ms: int) -> bool:
+        """Захватить или продлить блокировку key за owner"""
+        raise NotImplementedError
+
+
+class LocalBackplane(Backplane):
+    """Шина внутри одного процесса: публикация сразу вызывает обработчик"""
+
+    async def publish(self, channel: str, message: dict):
+        if channel in self.channels:
+            await self._handler(channel, message)
+
+    async def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    async def try_acquire(self, key: str, owner: str, ttl_ms: int) -> bool:
+        return True
+
+
+def encode_command(*args) -> bytes:
+    """Команда в формате RESP"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Прочитать один ответ RESP"""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Backplane connection closed")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b'+':
+        return payload.decode()
+    if kind == b'-':
+        raise RuntimeError(payload.decode())
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        size = int(payload)
+        if size < 0:
+            return None
+        data = await reader.readexactly(size + 2)
+        return data[:-2]
+    if kind == b'*':
+        size = int(payload)
+        if size < 0:
+            return None
+        return [await read_reply(reader) for _ in range(size)]
+    raise RuntimeError(f"Unexpected RESP reply: {line!r}")
+
+
+class RespBackplane(Backplane):
+    """Шина поверх Redis-совместимого сервера (TCP или Unix-сокет).
+
+    Используются два соединения: командное (PUBLISH, SET) с конвейерной
+    отправкой и подписочное (SUBSCRIBE), из которого читаются сообщения.
+    Разорванное соединение восстанавливается в фоне (подписки - заново),
+    а пока командного соединения нет, команды сразу падают с
+    BackplaneUnavailable. URL: redis://host:port или unix:///path/to.sock
+    """
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = urlparse(url)
+        self._replies: deque = deque()
+        self._cmd_task: Optional[asyncio.Task] = None
+        self._sub_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def _open(self):
+        if self.url.scheme == 'unix':
+            return await asyncio.open_unix_connection(self.url.path)
+        return await asyncio.open_connection(self.url.hostname or 'localhost', self.url.port or 6379)
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        await self._connect_commands()
+        await self._connect_subscriptions()
+
+    async def close(self):
+        self._closed = True
+        for task in (self._cmd_task, self._sub_task):
+            if task:
+                task.cancel()
+        for writer in (self._cmd_writer, self._sub_writer):
+            writer.close()
+
+    async def _connect_commands(self):
+        reader, self._cmd_writer = await self._open()
+        self._cmd_task = asyncio.create_task(self._read_replies(reader))
+
+    async def _connect_subscriptions(self):
+        reader, self._sub_writer = await self._open()
+        if self.channels:
+            self._sub_writer.write(encode_command('SUBSCRIBE', *self.channels))
+        self._sub_task = asyncio.create_task(self._read_messages(reader))
+
+    async def _reconnect(self, connect, name: str):
+        delay = RECONNECT_DELAY_START
+        while not self._closed:
+            await asyncio.sleep(delay)
+            try:
+                await connect()
+                print(f"Backplane {name} connection restored")
+                return
+            except OSError as e:
+                print(f"Backplane {name} reconnect failed: {e}")
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        """Ответы на команды приходят по порядку - раздаем их ожидающим"""
+        try:
+            while True:
+                try:
+                    reply = await read_reply(reader)
+                except RuntimeError as e:
+                    reply = e
+                future = self._replies.popleft()
+                # Ожидающий мог уйти по таймауту - ответ все равно занимает свое место
+                if future.done():
+                    continue
+                if isinstance(reply, Exception):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f"Backplane command connection lost: {e}")
+            while self._replies:
+                future = self._replies.popleft()
+                if not future.done():
+                    future.set_exception(BackplaneUnavailable("Backplane connection lost"))
+            if not self._closed:
+                asyncio.create_task(self._reconnect(self._connect_commands, "command"))
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and reply[0] == b'message':
+                    try:
+                        await self._handler(reply[1].decode(), loads(reply[2]))
+                    except Exception as e:
+                        print(f"Backplane handler error: {e}")
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            # Сообщения, опубликованные до переподключения, теряются
+            print(f"Backplane subscription connection lost: {e}")
+            if not self._closed:
+                asyncio.create_task(self._reconnect(self._connect_subscriptions, "subscription"))
+
+    async def _command(self, *args):
+        if self._cmd_task is None or self._cmd_task.done():
+            raise BackplaneUnavailable("Backplane is not connected")
+        future = asyncio.get_running_loop().create_future()
+        self._replies.append(future)
+        self._cmd_writer.write(encode_command(*args))
+        try:
+            return await asyncio.wait_for(future, BACKPLANE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise BackplaneUnavailable(f"No reply to {args[0]} in {BACKPLANE_TIMEOUT} s") from None
+
+    async def publish(self, channel: str, message: dict):
+        await self._command('PUBLISH', channel, dumps(message))
+
+    async def subscribe(self, channel: str):
+        if channel not in self.channels:
+            self.channels.add(channel)
+            self._sub_writer.write(encode_command('SUBSCRIBE', channel))
+
+    async def unsubscribe(self, channel: str):
+        if channel in self.channels:
+            self.channels.discard(channel)
+            self._sub_writer.write(encode_command('UNSUBSCRIBE', channel))
+
+    async def try_acquire(self, key: str, owner: str, ttl_ms: int) -> bool:
+        if await self._command('SET', key, owner, 'NX', 'PX', ttl_ms) == 'OK':
+            return True
+        # Продлеваем, только если ключ все еще наш: истекший и захваченный
+        # другим воркером ключ не перезаписывается
+        return await self._command('EVAL', RENEW_SCRIPT, 1, key, owner, ttl_ms) == 1
+
+
+def create_backplane(url: str) -> Backplane:
+    """Шина по URL из настроек: пустой URL - один процесс"""
+    if not url:
+        return LocalBackplane()
+    return RespBackplane(url)
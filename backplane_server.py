@@ -0,0 +1,133 @@
+"""Минимальный Redis-совместимый сервер для локального запуска нескольких воркеров.
+
+Поддерживает PING, PUBLISH, SUBSCRIBE, UNSUBSCRIBE, SET (NX, PX), GET, DEL
+и EVAL только для скрипта продления блокировки (RENEW_SCRIPT).
+
+Запуск:
+    python backplane_server.py --unix /tmp/chatminute.sock
+    BACKPLANE_URL=unix:///tmp/chatminute.sock uvicorn main:app --workers 4
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, Set, Tuple
+
+from backplane import RENEW_SCRIPT, encode_command, read_reply
+
+
+def _bulk(value: bytes) -> bytes:
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _subscription_reply(kind: bytes, channel: bytes, count: int) -> bytes:
+    """Ответ на (UN)SUBSCRIBE как у Redis: один массив [тип, канал, число подписок]"""
+    return b'*3\r\n' + _bulk(kind) + _bulk(channel) + b':%d\r\n' % count
+
+
+class BackplaneServer:
+    def __init__(self):
+        # канал -> подписчики
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        # ключ -> (значение, момент истечения или None)
+        self.keys: Dict[bytes, Tuple[bytes, float]] = {}
+
+    def _get(self, key: bytes):
+        item = self.keys.get(key)
+        if item and item[1] is not None and item[1] <= time.monotonic():
+            del self.keys[key]
+            return None
+        return item[0] if item else None
+
+    def _set(self, args) -> bytes:
+        key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+        expires = None
+        if b'PX' in options:
+            expires = time.monotonic() + int(args[2 + options.index(b'PX') + 1]) / 1000
+        if b'NX' in options and self._get(key) is not None:
+            return b'$-1\r\n'
+        self.keys[key] = (value, expires)
+        return b'+OK\r\n'
+
+    def _eval(self, args) -> bytes:
+        if args[0].decode() != RENEW_SCRIPT or int(args[1]) != 1:
+            return b'-ERR only the lock renewal script is supported\r\n'
+        key, owner, ttl_ms = args[2], args[3], int(args[4])
+        if self._get(key) != owner:
+            return b':0\r\n'
+        self.keys[key] = (owner, time.monotonic() + ttl_ms / 1000)
+        return b':1\r\n'
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    continue
+                name, args = command[0].upper(), command[1:]
+
+                if name == b'PING':
+                    writer.write(b'+PONG\r\n')
+                elif name == b'PUBLISH':
+                    subscribers = self.channels.get(args[0], ())
+                    frame = encode_command(b'message', args[0], args[1])
+                    for subscriber in subscribers:
+                        subscriber.write(frame)
+                    writer.write(b':%d\r\n' % len(subscribers))
+                elif name == b'SUBSCRIBE':
+                    for channel in args:
+                        self.channels.setdefault(channel, set()).add(writer)
+                        subscribed.add(channel)
+                        writer.write(_subscription_reply(b'subscribe', channel, len(subscribed)))
+                elif name == b'UNSUBSCRIBE':
+                    for channel in args:
+                        self._unsubscribe(channel, writer)
+                        subscribed.discard(channel)
+                        writer.write(_subscription_reply(b'unsubscribe', channel, len(subscribed)))
+                elif name == b'SET':
+                    writer.write(self._set(args))
+                elif name == b'GET':
+                    writer.write(_bulk(self._get(args[0])))
+                elif name == b'EVAL':
+                    writer.write(self._eval(args))
+                elif name == b'DEL':
+                    removed = sum(self.keys.pop(key, None) is not None for key in args)
+                    writer.write(b':%d\r\n' % removed)
+                else:
+                    writer.write(b'-ERR unknown command\r\n')
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._unsubscribe(channel, writer)
+            writer.close()
+
+    def _unsubscribe(self, channel: bytes, writer: asyncio.StreamWriter):
+        subscribers = self.channels.get(channel)
+        if subscribers:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.channels[channel]
+
+
+async def serve(unix_path: str = None, host: str = '127.0.0.1', port: int = 6379):
+    server = BackplaneServer()
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle_client, path=unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle_client, host, port)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--unix', help='путь к Unix-сокету')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    asyncio.run(serve(args.unix, args.host, args.port))
@@ -0,0 +1,348 @@
+"""Микробенчмарки горячих путей.
+
+Запуск: python bench.py [имя ...]
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from auth import HashingBusy, get_password_hash, verify_password, verify_password_async
+from database import Database, UserCache
+from match_queue import MatchQueue, ShardedMatchQueue, Waiter
+import numpy as np
+
+from matching import AGE_PENALTY_KM, MAX_AGE_DIFF, ScoringPool, gender_code, haversine_km
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def measure(fn, iterations: int) -> float:
+    """Операций в секунду"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return iterations / (time.perf_counter() - start)
+
+
+class UnpooledDatabase(Database):
+    """Прежнее поведение: новое соединение на каждый вызов"""
+
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+def bench_database(iterations: int = 5000):
+    """get_user_by_id и save_match_session: до и после пула"""
+    for name, cls in (('unpooled', UnpooledDatabase), ('pooled', Database)):
+        with tempfile.TemporaryDirectory() as tmp:
+            database = cls(os.path.join(tmp, 'bench.db'))
+            # Без кэша строк: сравниваем доступ к SQLite, а не UserCache
+            database.user_cache = UserCache(max_size=0)
+            user_ids = [database.create_user({
+                'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+                'first_name': 'Test', 'last_name': 'User', 'age': 25, 'gender': 'male'
+            }) for i in range(100)]
+            session = {
+                'id': str(uuid.uuid4()), 'user1_id': user_ids[0], 'user2_id': user_ids[1],
+                'room_id': str(uuid.uuid4()), 'started_at': '2024-01-01 00:00:00',
+                'user1_approval': None, 'user2_approval': None, 'is_matched': False, 'ended_at': None
+            }
+
+            reads = measure(lambda i: database.get_user_by_id(user_ids[i % 100]), iterations)
+            writes = measure(lambda i: database.save_match_session({**session, 'user1_approval': i % 2 == 0}), iterations // 5)
+            print(f"{name:>11}: get_user_by_id {reads:10.0f} ops/s | save_match_session {writes:10.0f} ops/s")
+            database.close()
+
+
+def bench_history(rows: int = 200000, page: int = 20):
+    """Страница истории связей: курсор против OFFSET на разной глубине"""
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'bench.db'))
+        user_ids = [database.create_user({
+            'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+            'first_name': 'Test', 'last_name': 'User', 'age': 25, 'gender': 'male'
+        }) for i in range(1000)]
+        conn = database.get_connection()
+        # Все связи у одного пользователя - самый тяжелый случай
+        conn.executemany(
+            'INSERT INTO connections (user1_id, user2_id, matched_at) VALUES (?, ?, ?)',
+            ((user_ids[0], user_ids[1 + i % 999], f'2024-01-01 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}')
+             for i in range(rows))
+        )
+        conn.commit()
+
+        for depth in (0, rows // 10, rows // 2, rows - page):
+            # Курсор на глубине depth - последняя строка предыдущей страницы
+            before = None
+            if depth:
+                row = conn.execute(
+                    'SELECT matched_at, id FROM connections ORDER BY matched_at DESC, id DESC LIMIT 1 OFFSET ?',
+                    (depth - 1,)
+                ).fetchone()
+                before = (row['matched_at'], row['id'])
+            keyset = 1 / measure(lambda _: database.get_connections_page(user_ids[0], before, page), 20)
+            offset = 1 / measure(lambda _: conn.execute(
+                'SELECT c.*, u.first_name FROM connections c JOIN users u ON u.id = c.user2_id '
+                'WHERE c.user1_id = ? OR c.user2_id = ? '
+                'ORDER BY c.matched_at DESC, c.id DESC LIMIT ? OFFSET ?',
+                (user_ids[0], user_ids[0], page, depth)
+            ).fetchall(), 20)
+            print(f"depth {depth:>7}: keyset {keyset * 1000:7.2f} ms | OFFSET {offset * 1000:7.2f} ms")
+        database.close()
+
+
+def bench_login_storm(logins: int = 64):
+    """Пропускная способность входа и задержка цикла событий во время шторма логинов.
+
+    Задержка цикла - время, на которое опаздывает пробник, просыпающийся
+    каждую миллисекунду; столько же ждало бы любое сообщение WebSocket.
+    """
+    password_hash = get_password_hash('password')
+
+    async def inline():
+        verify_password('password', password_hash)
+
+    async def pooled():
+        await verify_password_async('password', password_hash)
+
+    async def storm(verify):
+        lags = []
+        stop = asyncio.Event()
+
+        async def probe():
+            while not stop.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+
+        probe_task = asyncio.create_task(probe())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(verify() for _ in range(logins)), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe_task
+        rejected = sum(isinstance(r, HashingBusy) for r in results)
+        return (logins - rejected) / elapsed, rejected, percentile(lags, 0.99) * 1000
+
+    for name, verify in (('inline', inline), ('pooled', pooled)):
+        rate, rejected, p99 = asyncio.run(storm(verify))
+        print(f"{name:>11}: {rate:8.1f} logins/s | rejected (429) {rejected:3d} | loop lag p99 {p99:8.1f} ms")
+
+
+def match_score(user_data, candidate) -> float:
+    """Score пары: расстояние + штраф за разницу в возрасте"""
+    distance = haversine_km(user_data.lat, user_data.lng, candidate.lat, candidate.lng)
+    return float(distance) + abs(candidate.age - user_data.age) * AGE_PENALTY_KM
+
+
+def pool_best(pool: ScoringPool, user_data):
+    """user_id лучшего кандидата из пула одним векторным вызовом"""
+    n = len(pool)
+    age_diff = np.abs(pool.age[:n].astype(np.int32) - user_data.age)
+    score = haversine_km(user_data.lat, user_data.lng, pool.lat[:n], pool.lng[:n]) + age_diff * AGE_PENALTY_KM
+    score[(pool.gender[:n] == gender_code(user_data.gender)) | (age_diff > MAX_AGE_DIFF)] = np.inf
+    slot = int(np.argmin(score))
+    return int(pool.ids[slot]) if np.isfinite(score[slot]) else None
+
+
+def bench_scoring(sizes=(1000, 10000, 100000)):
+    """Score всех ожидающих для одного пользователя: цикл Python и ScoringPool"""
+    me = Waiter(0, 'male', 30, 55.75, 37.61)
+    for size in sizes:
+        waiting = [
+            Waiter(i, random.choice(('male', 'female')), random.randint(18, 60), random.uniform(41, 70), random.uniform(20, 180))
+            for i in range(1, size + 1)
+        ]
+        pool = ScoringPool()
+        for user in waiting:
+            pool.append(user.user_id, user.gender, user.age, user.lat, user.lng)
+
+        def python_loop():
+            best, best_score = None, math.inf
+            for candidate in waiting:
+                if candidate.gender == me.gender or abs(candidate.age - me.age) > MAX_AGE_DIFF:
+                    continue
+                score = match_score(me, candidate)
+                if score < best_score:
+                    best, best_score = candidate, score
+            return best
+
+        repeats = max(1, 100000 // size)
+        loop_ms = 1000 / measure(lambda i: python_loop(), max(1, repeats // 10))
+        pool_ms = 1000 / measure(lambda i: pool_best(pool, me), repeats)
+        print(f"{size:>10} waiters: python loop {loop_ms:9.2f} ms | ScoringPool {pool_ms:7.3f} ms")
+
+
+def bench_queue_memory(size: int = 100000):
+    """Память на очередь из size ожидающих: прежние dict в списке и MatchQueue"""
+    def allocated(build):
+        tracemalloc.start()
+        data = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del data
+        return current
+
+    def dict_list():
+        return [{
+            'user_id': i, 'gender': 'male' if i % 2 else 'female', 'age': 18 + i % 40,
+            'location': (55.0 + i * 1e-6, 37.0 + i * 1e-6)
+        } for i in range(size)]
+
+    def waiter_list():
+        return [Waiter(i, 'male' if i % 2 else 'female', 18 + i % 40, 55.0 + i * 1e-6, 37.0 + i * 1e-6) for i in range(size)]
+
+    def match_queue():
+        queue = MatchQueue()
+        for i in range(size):
+            queue.add(Waiter(i, 'male' if i % 2 else 'female', 18 + i % 40, 55.0 + i * 1e-6, 37.0 + i * 1e-6))
+        return queue
+
+    for name, build in (('dict list', dict_list), ('Waiter list', waiter_list), ('MatchQueue', match_queue)):
+        total = allocated(build)
+        print(f"{name:>11}: {total / 2**20:7.1f} MiB | {total / size:6.0f} bytes/waiter")
+
+    queue = match_queue()
+    start = time.perf_counter()
+    for i in range(0, size, 2):
+        queue.remove(i)
+    print(f" MatchQueue: removing {size // 2} waiters took {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def bench_widen(sizes=(2000, 10000, 20000), rounds: int = 10):
+    """Раунды подбора, когда долго ждущим в блоке 3x3 шардов некого подобрать: блокировка цикла событий"""
+    async def run(size: int):
+        queue = ShardedMatchQueue(cell_size=1.0, widen_after=0)
+        for i in range(size):
+            # Одни мужчины - пары нет ни в своем шарде, ни у соседей
+            queue.add(Waiter(i, 'male', 30, 55.5 + i % 3, 37.5 + i // 3 % 3))
+        lags = []
+
+        async def ticker():
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - start - 0.001)
+
+        task = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await queue.pair_round()
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        return elapsed / rounds, max(lags) if lags else 0.0
+
+    for size in sizes:
+        per_round, max_lag = asyncio.run(run(size))
+        print(f"{size:>6} stale waiters: round {per_round * 1000:8.1f} ms | max loop lag {max_lag * 1000:7.1f} ms")
+
+
+class FakeSocket:
+    """WebSocket, который только принимает кадры (медленный - с задержкой)"""
+
+    def __init__(self, delay: float = 0, on_send=None):
+        self.delay = delay
+        self.on_send = on_send
+        self.sent = 0
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, text: str):
+        await asyncio.sleep(self.delay)
+        self.sent += 1
+        if self.on_send:
+            self.on_send()
+
+    async def send_json(self, data):
+        # Как в Starlette: сериализация на каждый вызов
+        await self.send_text(json.dumps(data, separators=(',', ':'), ensure_ascii=False))
+
+
+def bench_broadcast(sockets: int = 10000, rounds: int = 5, slow_every: int = 100, slow_delay: float = 0.02):
+    """Рассылка одного сообщения на sockets соединений: все быстрые и каждый slow_every-й медленный"""
+    import main
+    from frames import orjson
+
+    manager = main.ConnectionManager()
+    message = {
+        "type": "match_success",
+        "message": "🎉 Вы понравились друг другу! Теперь вы можете общаться дальше.",
+        "room_id": str(uuid.uuid4())
+    }
+
+    async def run(slow_every):
+        delivered = 0
+        all_delivered = asyncio.Event()
+
+        def on_send():
+            nonlocal delivered
+            delivered += 1
+            if delivered == sockets * rounds:
+                all_delivered.set()
+
+        for user_id in range(sockets):
+            delay = slow_delay if slow_every and user_id % slow_every == 0 else 0
+            await manager.connect(FakeSocket(delay, on_send), user_id)
+        user_ids = list(manager.active_connections)
+
+        # Прежний путь: send_json для каждого получателя по очереди
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for user_id in user_ids:
+                await manager.active_connections[user_id].websocket.send_json(message)
+        elapsed = time.perf_counter() - start
+        print(f"send_json per user: {sockets * rounds / elapsed:10.0f} msgs/s | handler blocked {elapsed / rounds * 1000:7.1f} ms per broadcast")
+
+        # Очереди соединений: обработчик только ставит кадры, отправляют писатели
+        delivered = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await manager.broadcast(message, user_ids)
+        enqueued = time.perf_counter() - start
+        await all_delivered.wait()
+        elapsed = time.perf_counter() - start
+        print(f"         broadcast: {sockets * rounds / elapsed:10.0f} msgs/s | handler blocked {enqueued / rounds * 1000:7.1f} ms per broadcast")
+
+        for user_id in user_ids:
+            await manager.disconnect(user_id)
+
+    print(f"encoder: {'orjson' if orjson else 'json'}")
+    print("all sockets fast")
+    asyncio.run(run(0))
+    print(f"every {slow_every}th socket slow ({slow_delay * 1000:.0f} ms)")
+    asyncio.run(run(slow_every))
+
+
+BENCHMARKS = {
+    'database': bench_database,
+    'login_storm': bench_login_storm,
+    'scoring': bench_scoring,
+    'queue_memory': bench_queue_memory,
+    'widen': bench_widen,
+    'broadcast': bench_broadcast,
+    'history': bench_history,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,146 @@
+"""Проверка нескольких воркеров: шина backplane_server.py и два воркера uvicorn.
+
+Пользователи подключаются к разным воркерам; проверяется, что через шину
+проходят подбор пары, пересылка offer и ICE кандидатов и взаимный approve,
+изменение профиля сбрасывает кэш пользователя на другом воркере, а
+статистика на обоих воркерах одинаковая.
+
+Запуск: python cluster_check.py
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+from loadtest import ROOT, ServerProcess, free_port, http_post, wait_ready
+
+TIMEOUT = 10
+
+
+async def expect(ws, message_type: str) -> dict:
+    """Дождаться сообщения нужного типа, отвечая на ping и пропуская остальные"""
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        message = json.loads(await asyncio.wait_for(ws.recv(), deadline - time.monotonic()))
+        if message['type'] == 'ping':
+            await ws.send(json.dumps({'type': 'pong'}))
+        elif message['type'] == message_type:
+            return message
+
+
+def http_json(method: str, url: str, body: dict = None, token: str = None) -> dict:
+    request = urllib.request.Request(url, method=method, data=json.dumps(body).encode() if body else None)
+    request.add_header('Content-Type', 'application/json')
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+async def expect_profile(url: str, user_id: int, bio: str):
+    """Дождаться, пока воркер отдаст профиль с новым bio"""
+    deadline = time.monotonic() + TIMEOUT
+    while http_json('GET', f'{url}/api/user/{user_id}')['bio'] != bio:
+        if time.monotonic() > deadline:
+            raise AssertionError("profile update did not reach the other worker")
+        await asyncio.sleep(0.2)
+
+
+async def expect_stats(urls: list, expected: dict):
+    """Дождаться, пока все воркеры отдадут одинаковую статистику с нужными значениями"""
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        stats = []
+        for url in urls:
+            with urllib.request.urlopen(f'{url}/api/stats', timeout=5) as response:
+                stats.append(json.loads(response.read()))
+        if all(s == stats[0] for s in stats) and all(stats[0][k] == v for k, v in expected.items()):
+            return
+        if time.monotonic() > deadline:
+            raise AssertionError(f"stats differ: {stats}")
+        await asyncio.sleep(0.2)
+
+
+def register(base_url: str, name: str, gender: str) -> tuple:
+    http_post(f'{base_url}/api/register', {
+        'username': name, 'email': f'{name}@example.com', 'password': 'password',
+        'first_name': name, 'last_name': 'Check', 'age': '30', 'gender': gender
+    })
+    login = http_post(f'{base_url}/api/login', {'username': name, 'password': 'password'})
+    return login['user']['id'], login['access_token']
+
+
+async def check(workdir: str):
+    socket_path = os.path.join(workdir, 'backplane.sock')
+    backplane = subprocess.Popen([sys.executable, 'backplane_server.py', '--unix', socket_path], cwd=ROOT)
+    workers = []
+    try:
+        while not os.path.exists(socket_path):
+            await asyncio.sleep(0.05)
+        for number in (1, 2):
+            workers.append(ServerProcess(free_port(), 30, workdir, {
+                'BACKPLANE_URL': f'unix://{socket_path}',
+                'WORKER_ID': f'worker-{number}',
+            }))
+        urls = [f'http://127.0.0.1:{worker.port}' for worker in workers]
+        for url in urls:
+            await wait_ready(url)
+
+        # БД общая, так что регистрироваться можно на любом воркере
+        alice_id, alice_token = register(urls[0], 'alice', 'female')
+        bob_id, bob_token = register(urls[1], 'bob', 'male')
+
+        # Строка alice попадает в кэш второго воркера, а профиль меняется на первом
+        http_json('GET', f'{urls[1]}/api/user/{alice_id}')
+        http_json('PUT', f'{urls[0]}/api/profile', {'bio': 'updated'}, alice_token)
+        await expect_profile(urls[1], alice_id, 'updated')
+        print("profile cache invalidation across workers: OK")
+
+        async with websockets.connect(f'ws://127.0.0.1:{workers[0].port}/ws/{alice_id}?token={alice_token}') as alice, \
+                websockets.connect(f'ws://127.0.0.1:{workers[1].port}/ws/{bob_id}?token={bob_token}') as bob:
+            for ws in (alice, bob):
+                await ws.send(json.dumps({'type': 'start_search'}))
+                await expect(ws, 'search_started')
+
+            alice_match, bob_match = await expect(alice, 'match_found'), await expect(bob, 'match_found')
+            assert alice_match['partner_id'] == bob_id and bob_match['partner_id'] == alice_id
+            assert alice_match['room_id'] == bob_match['room_id']
+            room_id = alice_match['room_id']
+            print("match across workers: OK")
+
+            # Онлайн у каждого воркера свой, сессия - только у координатора
+            await expect_stats(urls, {'online_users': 2, 'active_sessions': 1, 'waiting_users': 0})
+            print("stats across workers: OK")
+
+            await alice.send(json.dumps({'type': 'webrtc_offer', 'offer': {'type': 'offer', 'sdp': 'v=0'},
+                                         'target_user_id': bob_id}))
+            offer = await expect(bob, 'webrtc_offer')
+            assert offer['from_user_id'] == alice_id and offer['offer']['sdp'] == 'v=0'
+            await bob.send(json.dumps({'type': 'ice_candidate', 'candidate': {'candidate': 'candidate:0'},
+                                       'target_user_id': alice_id}))
+            candidates = await expect(alice, 'ice_candidates')
+            assert candidates['from_user_id'] == bob_id and candidates['candidates'] == [{'candidate': 'candidate:0'}]
+            print("signaling relay across workers: OK")
+
+            for ws in (alice, bob):
+                await ws.send(json.dumps({'type': 'approve', 'room_id': room_id}))
+            for ws in (alice, bob):
+                assert (await expect(ws, 'match_success'))['room_id'] == room_id
+            print("mutual approve across workers: OK")
+    finally:
+        for worker in workers:
+            worker.stop()
+        backplane.terminate()
+        backplane.wait()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as workdir:
+        asyncio.run(check(workdir))
+    print("OK: workers cooperate through the backplane")
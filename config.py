@@ -0,0 +1,92 @@
+import os
+import socket
+
+# Настройки приложения (переопределяются переменными окружения)
+
+# Интервал раунда подбора пар (секунды)
+MATCH_TICK_INTERVAL = float(os.getenv("MATCH_TICK_INTERVAL", "0.5"))
+# Сколько самых давних ожидающих попадает в матрицу стоимости за раунд
+MATCH_BATCH_LIMIT = int(os.getenv("MATCH_BATCH_LIMIT", "2000"))
+# Сколько лучших кандидатов на пользователя рассматривает жадное назначение
+MATCH_CANDIDATES_PER_USER = int(os.getenv("MATCH_CANDIDATES_PER_USER", "8"))
+
+# Файл базы данных SQLite
+DB_PATH = os.getenv("DB_PATH", "dating_app.db")
+# SQLite: ожидание блокировки (мс), режим synchronous, размер кэша подготовленных запросов
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+# Размер пула потоков для чтения из БД
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+
+# Интервал пакетной записи онлайн-статусов в БД (секунды)
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "1.0"))
+
+# Кэш профилей пользователей: максимальный размер и время жизни записи (секунды)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Максимальное число проверенных JWT в кэше
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "50000"))
+
+# Параметры argon2 (память в КиБ)
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "4"))
+# Потоки для хеширования паролей и сколько запросов может ждать в очереди (дальше - 429)
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "4"))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", "32"))
+
+# Длительность видеосессии до решения (секунды)
+SESSION_DURATION = int(os.getenv("SESSION_DURATION", "60"))
+# Колесо таймеров: шаг (секунды) и число слотов
+TIMER_TICK = float(os.getenv("TIMER_TICK", "0.5"))
+TIMER_SLOTS = int(os.getenv("TIMER_SLOTS", "512"))
+
+# Шина между воркерами: пусто - один процесс, иначе redis://host:port или unix:///path.sock
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", "")
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Сколько ждать ответа шины на команду (секунды)
+BACKPLANE_TIMEOUT = float(os.getenv("BACKPLANE_TIMEOUT", "2"))
+# Время жизни роли координатора без продления (мс)
+COORDINATOR_TTL_MS = int(os.getenv("COORDINATOR_TTL_MS", "5000"))
+
+# Шарды очереди поиска: размер региона (градусы) и через сколько секунд ожидания искать у соседей
+SHARD_CELL_SIZE = float(os.getenv("SHARD_CELL_SIZE", "5.0"))
+SHARD_WIDEN_AFTER = float(os.getenv("SHARD_WIDEN_AFTER", "10"))
+# Поиск у соседей: сколько ожидающих за раунд и максимальная пауза (секунды) между
+# попытками для того, кому не нашлось пары (пауза удваивается с каждой попыткой)
+SHARD_WIDEN_LIMIT = int(os.getenv("SHARD_WIDEN_LIMIT", "500"))
+SHARD_WIDEN_BACKOFF_MAX = float(os.getenv("SHARD_WIDEN_BACKOFF_MAX", "30"))
+
+# Недавние собеседники не подбираются повторно: сколько помнить пару (секунды),
+# пар на поколение фильтра и допустимая доля ложных срабатываний
+RECENT_PARTNER_TTL = float(os.getenv("RECENT_PARTNER_TTL", "1800"))
+RECENT_PARTNER_CAPACITY = int(os.getenv("RECENT_PARTNER_CAPACITY", "100000"))
+RECENT_PARTNER_FP_RATE = float(os.getenv("RECENT_PARTNER_FP_RATE", "0.01"))
+
+# Статистика: как часто сверять счетчики с БД и сколько клиент может кэшировать ответ (секунды)
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "60"))
+STATS_MAX_AGE = int(os.getenv("STATS_MAX_AGE", "2"))
+# Как часто проверять статистику и рассылать изменения подписчикам WebSocket (секунды)
+STATS_PUSH_INTERVAL = float(os.getenv("STATS_PUSH_INTERVAL", "1.0"))
+# Сколько учитывать значения другого воркера после его последней публикации (секунды)
+STATS_WORKER_TTL = float(os.getenv("STATS_WORKER_TTL", "5"))
+
+# Исходящая очередь соединения: размер и что делать при переполнении
+# (drop_stale - выбросить старый ICE кандидат или статистику, disconnect - отключить клиента)
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "drop_stale")
+
+# Сигналинг: окно склейки ICE кандидатов (секунды) и логирование каждого N-го сигнала
+ICE_BATCH_WINDOW = float(os.getenv("ICE_BATCH_WINDOW", "0.02"))
+SIGNAL_LOG_SAMPLE = int(os.getenv("SIGNAL_LOG_SAMPLE", "100"))
+
+# Heartbeat: как часто пинговать простаивающие соединения и через сколько секунд
+# тишины считать соединение мертвым (больше двух интервалов, чтобы клиент успел ответить)
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "15"))
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "45"))
+
+# Постраничная история (/api/connections, /api/history): размер страницы по умолчанию и максимум
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "20"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "100"))
@@ -1,80 +1,114 @@
 import sqlite3
 import json
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import hashlib
 import os
 
+from config import (
+    DB_PATH, DB_BUSY_TIMEOUT_MS, DB_SYNCHRONOUS, DB_CACHED_STATEMENTS, DB_READ_WORKERS,
+    USER_CACHE_SIZE, USER_CACHE_TTL
+)
+from metrics import DB_QUERY_SECONDS
+from migrations import migrate
+
+# Курсор первой страницы: позже любой метки времени CURRENT_TIMESTAMP
+PAGE_START = '9999-12-31 23:59:59'
+
+class UserCache:
+    """Ограниченный LRU-кэш строк пользователей с TTL.
+
+    Онлайн статус в закэшированной строке может отставать - источник истины
+    для него PresenceTracker. Кэш у каждого воркера свой: при нескольких
+    воркерах изменение профиля сбрасывается у остальных через шину
+    (канал user_invalidate в main.py).
+    """
+    
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Растет при каждой инвалидации: строку, прочитанную до нее, класть нельзя
+        self.generation = 0
+        # user_id -> (момент устаревания, строка)
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._items.move_to_end(user_id)
+            self.hits += 1
+            return dict(item[1])
+    
+    def put(self, user_id: int, user: Dict[str, Any], generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[user_id] = (time.monotonic() + self.ttl, dict(user))
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            self._items.pop(user_id, None)
+    
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
 class Database:
-    def __init__(self, db_path: str = "dating_app.db"):
+    def __init__(self, db_path: str = DB_PATH):
         self.db_path = db_path
+        # Постоянное соединение для каждого потока
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.user_cache = UserCache()
         self.init_database()
     
     def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE,
-                    password_hash TEXT NOT NULL,
-                    first_name TEXT NOT NULL,
-                    last_name TEXT NOT NULL,
-                    age INTEGER NOT NULL,
-                    gender TEXT NOT NULL,
-                    bio TEXT,
-                    interests TEXT,
-                    location_lat REAL DEFAULT 55.7558,
-                    location_lng REAL DEFAULT 37.6173,
-                    is_online BOOLEAN DEFAULT FALSE,
-                    last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица сессий матчей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS match_sessions (
-                    id TEXT PRIMARY KEY,
-                    user1_id INTEGER NOT NULL,
-                    user2_id INTEGER NOT NULL,
-                    room_id TEXT UNIQUE NOT NULL,
-                    started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    user1_approval BOOLEAN,
-                    user2_approval BOOLEAN,
-                    is_matched BOOLEAN DEFAULT FALSE,
-                    ended_at DATETIME,
-                    FOREIGN KEY (user1_id) REFERENCES users (id),
-                    FOREIGN KEY (user2_id) REFERENCES users (id)
-                )
-            ''')
-            
-            # Таблица связей (matches)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS connections (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user1_id INTEGER NOT NULL,
-                    user2_id INTEGER NOT NULL,
-                    matched_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    FOREIGN KEY (user1_id) REFERENCES users (id),
-                    FOREIGN KEY (user2_id) REFERENCES users (id)
-                )
-            ''')
-            
-            conn.commit()
+        """Инициализация базы данных: применение недостающих миграций схемы"""
+        migrate(self.get_connection())
     
     def get_connection(self):
-        """Получить соединение с базой данных"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """Получить соединение с базой данных (одно на поток)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                check_same_thread=False,  # close() вызывается из другого потока
+                cached_statements=DB_CACHED_STATEMENTS
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+            conn.execute(f'PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT_MS)}')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
         return conn
     
+    def close(self):
+        """Закрыть все открытые соединения"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+    
     # Методы для работы с пользователями
     def create_user(self, user_data: Dict[str, Any]) -> int:
         """Создать нового пользователя"""
@@ -100,15 +134,25 @@ class Database:
             ))
             user_id = cursor.lastrowid
             conn.commit()
+            self.user_cache.invalidate(user_id)
             return user_id
     
     def get_user_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить пользователя по ID"""
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        generation = self.user_cache.generation
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
             row = cursor.fetchone()
-            return dict(row) if row else None
+            if not row:
+                return None
+            user = dict(row)
+            self.user_cache.put(user_id, user, generation)
+            return user
     
     def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
         """Получить пользователя по имени"""
@@ -151,65 +195,47 @@ class Database:
                 WHERE id = ?
             ''', values)
             conn.commit()
+        self.user_cache.invalidate(user_id)
     
-    def update_user_online_status(self, user_id: int, is_online: bool):
-        """Обновить онлайн статус пользователя"""
+    def update_users_online_status(self, updates: List[tuple]):
+        """Пакетно обновить онлайн статусы: [(is_online, last_seen, user_id), ...]"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
+            cursor.executemany('''
                 UPDATE users 
-                SET is_online = ?, last_seen = CURRENT_TIMESTAMP
+                SET is_online = ?, last_seen = ?
                 WHERE id = ?
-            ''', (is_online, user_id))
+            ''', updates)
             conn.commit()
     
-    # Методы для работы с матч-сессиями
-    def create_match_session(self, user1_id: int, user2_id: int, room_id: str, session_id: str):
-        """Создать сессию матча"""
+    def reset_online_status(self):
+        """Сбросить онлайн статус всех пользователей (после перезапуска сервера)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO match_sessions (id, user1_id, user2_id, room_id)
-                VALUES (?, ?, ?, ?)
-            ''', (session_id, user1_id, user2_id, room_id))
+            cursor.execute('UPDATE users SET is_online = FALSE WHERE is_online = TRUE')
             conn.commit()
     
-    def get_match_session_by_room(self, room_id: str) -> Optional[Dict[str, Any]]:
-        """Получить сессию по room_id"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM match_sessions WHERE room_id = ?', (room_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
-    
-    def update_match_session_approval(self, session_id: str, user_id: int, approval: bool):
-        """Обновить статус одобрения в сессии"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            # Определяем, какой пользователь (user1 или user2)
-            cursor.execute('SELECT user1_id, user2_id FROM match_sessions WHERE id = ?', (session_id,))
-            session = cursor.fetchone()
-            
-            if session:
-                user1_id = session['user1_id']
-                field = 'user1_approval' if user_id == user1_id else 'user2_approval'
-                
-                cursor.execute(f'''
-                    UPDATE match_sessions 
-                    SET {field} = ?
-                    WHERE id = ?
-                ''', (approval, session_id))
-                conn.commit()
-    
-    def complete_match_session(self, session_id: str, is_matched: bool = False):
-        """Завершить сессию матча"""
+    # Методы для работы с матч-сессиями
+    def save_match_session(self, session: Dict[str, Any]):
+        """Сохранить завершенную сессию целиком"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                UPDATE match_sessions 
-                SET ended_at = CURRENT_TIMESTAMP, is_matched = ?
-                WHERE id = ?
-            ''', (is_matched, session_id))
+                INSERT OR REPLACE INTO match_sessions (
+                    id, user1_id, user2_id, room_id, started_at,
+                    user1_approval, user2_approval, is_matched, ended_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                session['id'],
+                session['user1_id'],
+                session['user2_id'],
+                session['room_id'],
+                session['started_at'],
+                session['user1_approval'],
+                session['user2_approval'],
+                session['is_matched'],
+                session['ended_at']
+            ))
             conn.commit()
     
     def create_connection(self, user1_id: int, user2_id: int):
@@ -222,30 +248,129 @@ class Database:
             ''', (min(user1_id, user2_id), max(user1_id, user2_id)))
             conn.commit()
     
+    # Постраничная история: курсор - (время, id) последней строки предыдущей страницы
+    def get_connections_page(self, user_id: int, before: Optional[tuple], limit: int) -> List[Dict[str, Any]]:
+        """Связи пользователя от новых к старым вместе с профилем собеседника"""
+        matched_at, connection_id = before or (PAGE_START, 0)
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Две половины по покрывающим индексам (пользователь бывает и user1, и user2),
+            # каждая не больше limit строк
+            cursor.execute('''
+                SELECT c.id, c.matched_at, c.is_active, u.id AS partner_id,
+                       u.first_name, u.last_name, u.age, u.gender, u.bio
+                FROM (
+                    SELECT * FROM (
+                        SELECT id, matched_at, is_active, user2_id AS partner_id FROM connections
+                        WHERE user1_id = :user_id AND (matched_at, id) < (:matched_at, :id)
+                        ORDER BY matched_at DESC, id DESC LIMIT :limit
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT id, matched_at, is_active, user1_id AS partner_id FROM connections
+                        WHERE user2_id = :user_id AND (matched_at, id) < (:matched_at, :id)
+                        ORDER BY matched_at DESC, id DESC LIMIT :limit
+                    )
+                ) c
+                JOIN users u ON u.id = c.partner_id
+                ORDER BY c.matched_at DESC, c.id DESC
+                LIMIT :limit
+            ''', {'user_id': user_id, 'matched_at': matched_at, 'id': connection_id, 'limit': limit})
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_history_page(self, user_id: int, before: Optional[tuple], limit: int) -> List[Dict[str, Any]]:
+        """Завершенные сессии пользователя от новых к старым вместе с профилем собеседника"""
+        started_at, session_id = before or (PAGE_START, '')
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT s.id, s.started_at, s.ended_at, s.is_matched, u.id AS partner_id,
+                       u.first_name, u.last_name, u.age, u.gender, u.bio
+                FROM (
+                    SELECT * FROM (
+                        SELECT id, started_at, ended_at, is_matched, user2_id AS partner_id FROM match_sessions
+                        WHERE user1_id = :user_id AND (started_at, id) < (:started_at, :id)
+                        ORDER BY started_at DESC, id DESC LIMIT :limit
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT id, started_at, ended_at, is_matched, user1_id AS partner_id FROM match_sessions
+                        WHERE user2_id = :user_id AND (started_at, id) < (:started_at, :id)
+                        ORDER BY started_at DESC, id DESC LIMIT :limit
+                    )
+                ) s
+                JOIN users u ON u.id = s.partner_id
+                ORDER BY s.started_at DESC, s.id DESC
+                LIMIT :limit
+            ''', {'user_id': user_id, 'started_at': started_at, 'id': session_id, 'limit': limit})
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_recent_pairs(self, seconds: float) -> List[Dict[str, Any]]:
+        """Пары собеседников из сессий, завершившихся за последние seconds секунд"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user1_id, user2_id,
+                       (julianday('now') - julianday(ended_at)) * 86400 AS age
+                FROM match_sessions
+                WHERE ended_at >= datetime('now', ?)
+            ''', (f'-{int(seconds)} seconds',))
+            return [dict(row) for row in cursor.fetchall()]
+    
     # Методы для статистики
-    def get_stats(self) -> Dict[str, int]:
-        """Получить статистику приложения"""
+    def get_totals(self) -> Dict[str, int]:
+        """Итоговое число пользователей и связей"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute('SELECT COUNT(*) as total FROM users')
-            total_users = cursor.fetchone()['total']
-            
-            cursor.execute('SELECT COUNT(*) as online FROM users WHERE is_online = TRUE')
-            online_users = cursor.fetchone()['online']
-            
-            cursor.execute('SELECT COUNT(*) as matches FROM connections')
-            total_matches = cursor.fetchone()['matches']
-            
-            cursor.execute('SELECT COUNT(*) as sessions FROM match_sessions WHERE ended_at IS NULL')
-            active_sessions = cursor.fetchone()['sessions']
-            
-            return {
-                'total_users': total_users,
-                'online_users': online_users,
-                'total_matches': total_matches,
-                'active_sessions': active_sessions
-            }
+            cursor.execute('''
+                SELECT (SELECT COUNT(*) FROM users) AS total_users,
+                       (SELECT COUNT(*) FROM connections) AS total_matches
+            ''')
+            return dict(cursor.fetchone())
+    
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database с тем же набором методов.
+
+    Все записи выполняются по очереди в одном потоке-писателе, чтения - в
+    пуле потоков, так что цикл событий не блокируется на диске.
+    """
+    
+    WRITE_METHODS = {
+        'create_user', 'update_user', 'update_users_online_status',
+        'reset_online_status', 'save_match_session', 'create_connection'
+    }
+    
+    def __init__(self, database: Database, read_workers: int = DB_READ_WORKERS):
+        self.database = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader')
+    
+    def __getattr__(self, name: str):
+        method = getattr(self.database, name)
+        executor = self._writer if name in self.WRITE_METHODS else self._readers
+        
+        def timed(*args, **kwargs):
+            # Время самого запроса в потоке, без ожидания в очереди пула
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - start, name)
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(timed, *args, **kwargs))
+        
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+    
+    def shutdown(self):
+        """Дождаться выполнения всех запросов и остановить потоки"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
 
 # Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+db = Database()
+adb = AsyncDatabase(db)
\ No newline at end of file
@@ -0,0 +1,24 @@
+"""Сериализация сообщений WebSocket и шины.
+
+Если установлен orjson, используется он (в несколько раз быстрее
+стандартного json); иначе - json с компактными разделителями. Результат
+одинаково читается клиентом.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def dumps(message) -> str:
+        return orjson.dumps(message).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(message) -> str:
+        return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+    loads = json.loads
@@ -0,0 +1,312 @@
+"""Нагрузочный тест: тысячи пользователей через настоящий протокол WebSocket.
+
+Поднимает локальный сервер (uvicorn main:app) с временной БД, регистрирует
+N пользователей и прогоняет полный сценарий: поиск, offer/answer/ICE,
+approve/reject и истечение сессии. Печатает матчи в секунду, перцентили
+времени до матча и задержки сигналинга, CPU и RSS сервера.
+
+Запуск: python loadtest.py --users 1000 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+
+import websockets
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ServerProcess:
+    """Локальный сервер с временной БД и замером CPU/RSS через /proc"""
+
+    def __init__(self, port: int, session_duration: float, workdir: str, extra_env: dict = None):
+        self.port = port
+        env = dict(os.environ)
+        env.update({
+            'DB_PATH': os.path.join(workdir, 'loadtest.db'),
+            'SESSION_DURATION': str(int(session_duration)),
+            # Argon2 с параметрами по умолчанию упрется в 429 при массовой регистрации
+            'ARGON2_MEMORY_COST': env.get('ARGON2_MEMORY_COST', '1024'),
+            'ARGON2_TIME_COST': env.get('ARGON2_TIME_COST', '1'),
+            'HASH_QUEUE_SIZE': env.get('HASH_QUEUE_SIZE', '100000'),
+            'SIGNAL_LOG_SAMPLE': env.get('SIGNAL_LOG_SAMPLE', '100000'),
+        })
+        env.update(extra_env or {})
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1',
+             '--port', str(port), '--log-level', 'warning', '--ws-max-queue', '1024'],
+            cwd=ROOT, env=env
+        )
+        self.peak_rss = 0
+        self._cpu_start = None
+
+    def _read_proc(self):
+        """(процессорное время в секундах, RSS в байтах) или None не на Linux"""
+        try:
+            with open(f'/proc/{self.process.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{self.process.pid}/statm') as f:
+                rss_pages = int(f.read().split()[1])
+        except OSError:
+            return None
+        ticks = os.sysconf('SC_CLK_TCK')
+        return (int(fields[11]) + int(fields[12])) / ticks, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+    def start_measuring(self):
+        sample = self._read_proc()
+        self._cpu_start = (time.perf_counter(), sample[0]) if sample else None
+
+    def sample(self):
+        sample = self._read_proc()
+        if sample:
+            self.peak_rss = max(self.peak_rss, sample[1])
+
+    def cpu_percent(self) -> float:
+        sample = self._read_proc()
+        if not sample or not self._cpu_start:
+            return float('nan')
+        wall = time.perf_counter() - self._cpu_start[0]
+        return (sample[0] - self._cpu_start[1]) / wall * 100
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def http_post(url: str, fields: dict) -> dict:
+    data = urllib.parse.urlencode(fields).encode()
+    with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=30) as response:
+        return json.loads(response.read())
+
+
+async def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await asyncio.to_thread(urllib.request.urlopen, f'{base_url}/health', timeout=1)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def register_users(base_url: str, count: int, concurrency: int):
+    """Регистрация и вход; повтор при 429 от пула хеширования"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def register(i: int):
+        fields = {
+            'username': f'load{i}', 'email': f'load{i}@example.com', 'password': 'password',
+            'first_name': 'Load', 'last_name': str(i), 'age': str(random.randint(25, 32)),
+            'gender': 'male' if i % 2 else 'female',
+            'location_lat': str(55.75 + random.uniform(-0.5, 0.5)),
+            'location_lng': str(37.61 + random.uniform(-0.5, 0.5)),
+        }
+        async with semaphore:
+            while True:
+                try:
+                    await asyncio.to_thread(http_post, f'{base_url}/api/register', fields)
+                    login = await asyncio.to_thread(http_post, f'{base_url}/api/login', {
+                        'username': fields['username'], 'password': fields['password']
+                    })
+                    return login['user']['id'], login['access_token']
+                except urllib.error.HTTPError as e:
+                    if e.code != 429:
+                        raise
+                    await asyncio.sleep(0.1)
+
+    return await asyncio.gather(*(register(i) for i in range(count)))
+
+
+class Report:
+    def __init__(self):
+        self.time_to_match = []
+        self.signal_latency = defaultdict(list)
+        self.outcomes = Counter()
+        self.matches = 0
+        self.errors = Counter()
+
+
+class Dater:
+    """Один пользователь: ищет пару, обменивается сигналами и решает"""
+
+    def __init__(self, user_id: int, token: str, ws_url: str, report: Report, args):
+        self.user_id = user_id
+        self.token = token
+        self.ws_url = ws_url
+        self.report = report
+        self.args = args
+        self.ws = None
+        self.room_id = None
+        self.partner_id = None
+        self.search_started_at = None
+
+    async def send(self, message: dict):
+        await self.ws.send(json.dumps(message))
+
+    async def start_search(self):
+        self.room_id = None
+        self.partner_id = None
+        self.search_started_at = time.perf_counter()
+        await self.send({'type': 'start_search'})
+
+    async def send_signals(self, kind: str):
+        payload = {'type': f'webrtc_{kind}', kind: {'type': kind, 'sdp': 'v=0', 'sent_at': time.perf_counter()},
+                   'target_user_id': self.partner_id}
+        await self.send(payload)
+        for i in range(self.args.candidates):
+            await self.send({
+                'type': 'ice_candidate',
+                'candidate': {'candidate': f'candidate:{i} 1 udp 2122260223 10.0.0.1 5{i:04d} typ host',
+                              'sdpMid': '0', 'sdpMLineIndex': 0, 'sent_at': time.perf_counter()},
+                'target_user_id': self.partner_id
+            })
+
+    async def decide(self, room_id: str):
+        """Через время "разговора" одобрить, отказать или дождаться истечения"""
+        await asyncio.sleep(random.uniform(0, self.args.think))
+        if self.room_id != room_id:
+            return
+        choice = random.random()
+        try:
+            if choice < self.args.approve:
+                await self.send({'type': 'approve', 'room_id': room_id})
+            elif choice < self.args.approve + self.args.reject:
+                await self.send({'type': 'reject', 'room_id': room_id})
+                self.report.outcomes['rejected'] += 1
+                await self.start_search()
+        except websockets.ConnectionClosed:
+            # Тест закончился, пока пользователь думал
+            pass
+
+    async def handle(self, message: dict):
+        message_type = message.get('type')
+        now = time.perf_counter()
+
+        if message_type == 'ping':
+            await self.send({'type': 'pong'})
+
+        elif message_type == 'match_found':
+            self.report.time_to_match.append(now - self.search_started_at)
+            self.report.matches += 1
+            self.room_id = message['room_id']
+            self.partner_id = message['partner_id']
+            if self.user_id < self.partner_id:
+                await self.send_signals('offer')
+            asyncio.create_task(self.decide(self.room_id))
+
+        elif message_type == 'webrtc_offer':
+            self.report.signal_latency['offer'].append(now - message['offer']['sent_at'])
+            await self.send_signals('answer')
+
+        elif message_type == 'webrtc_answer':
+            self.report.signal_latency['answer'].append(now - message['answer']['sent_at'])
+
+        elif message_type == 'ice_candidates':
+            for candidate in message['candidates']:
+                self.report.signal_latency['ice_candidate'].append(now - candidate['sent_at'])
+
+        elif message_type in ('match_success', 'match_rejected', 'time_expired'):
+            outcome = {'match_success': 'matched', 'match_rejected': 'rejected', 'time_expired': 'expired'}
+            self.report.outcomes[outcome[message_type]] += 1
+            await self.start_search()
+
+    async def run(self, stop_at: float):
+        try:
+            async with websockets.connect(f'{self.ws_url}/ws/{self.user_id}?token={self.token}', max_queue=None) as ws:
+                self.ws = ws
+                await self.start_search()
+                while True:
+                    timeout = stop_at - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    await self.handle(json.loads(raw))
+        except Exception as e:
+            self.report.errors[type(e).__name__] += 1
+
+
+def print_latencies(name: str, values):
+    if not values:
+        print(f"{name:>16}: no samples")
+        return
+    ms = [v * 1000 for v in values]
+    print(f"{name:>16}: p50 {percentile(ms, 0.5):8.1f} ms | p90 {percentile(ms, 0.9):8.1f} ms | "
+          f"p99 {percentile(ms, 0.99):8.1f} ms | n={len(ms)}")
+
+
+async def run(args):
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory() as workdir:
+        server = ServerProcess(port, args.session_duration, workdir)
+        try:
+            await wait_ready(base_url)
+            start = time.perf_counter()
+            users = await register_users(base_url, args.users, args.concurrency)
+            print(f"registered {len(users)} users in {time.perf_counter() - start:.1f} s")
+
+            report = Report()
+            server.start_measuring()
+            stop_at = time.monotonic() + args.duration
+            daters = [Dater(user_id, token, f'ws://127.0.0.1:{port}', report, args) for user_id, token in users]
+            tasks = [asyncio.create_task(dater.run(stop_at)) for dater in daters]
+
+            started = time.perf_counter()
+            while not all(task.done() for task in tasks):
+                server.sample()
+                await asyncio.sleep(0.5)
+            elapsed = time.perf_counter() - started
+            cpu = server.cpu_percent()
+        finally:
+            server.stop()
+
+    print(f"users {args.users} | duration {elapsed:.1f} s")
+    print(f"matches: {report.matches // 2} ({report.matches / 2 / elapsed:.1f}/s) | outcomes: {dict(report.outcomes)}")
+    print_latencies('time to match', report.time_to_match)
+    for kind in ('offer', 'answer', 'ice_candidate'):
+        print_latencies(kind, report.signal_latency[kind])
+    print(f"server CPU {cpu:.0f}% | peak RSS {server.peak_rss / 2**20:.0f} MiB")
+    if report.errors:
+        print(f"client errors: {dict(report.errors)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='число пользователей')
+    parser.add_argument('--duration', type=float, default=30, help='длительность теста (секунды)')
+    parser.add_argument('--session-duration', type=float, default=5, help='SESSION_DURATION сервера (секунды)')
+    parser.add_argument('--candidates', type=int, default=8, help='ICE кандидатов с каждой стороны')
+    parser.add_argument('--think', type=float, default=3, help='максимальное время до решения (секунды)')
+    parser.add_argument('--approve', type=float, default=0.4, help='вероятность approve')
+    parser.add_argument('--reject', type=float, default=0.3, help='вероятность reject (иначе ждем истечения)')
+    parser.add_argument('--concurrency', type=int, default=32, help='одновременных регистраций')
+    asyncio.run(run(parser.parse_args()))
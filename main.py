@@ -1,18 +1,43 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Form, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import json
-import uuid
 import asyncio
+import base64
+import heapq
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import math
+from typing import Dict, Iterable, List, Optional, Set
 import os
 import socket
+import time
 
-from database import db
-from auth import verify_password, get_password_hash, create_access_token, verify_token
+from database import db, adb
+from match_queue import ShardedMatchQueue, Waiter
+from matching import GENDERS
+from recent_partners import RecentPartners
+from presence import PresenceTracker
+from stats import AppStats
+from timer_wheel import TimerWheel
+from sessions import SessionRegistry, MatchSession, MATCHED, REJECTED, EXPIRED
+from backplane import BackplaneUnavailable, create_backplane, user_channel
+from frames import dumps, loads
+from outbound import OutboundQueue
+from signaling import SIGNAL_MESSAGES, ROOM_EVENTS, CandidateBatcher, SampledLog, with_sender
+from metrics import (
+    registry, MATCH_WAIT_SECONDS, MATCH_ROUND_SECONDS, MATCHES_TOTAL,
+    WS_MESSAGE_SECONDS, SIGNAL_FANOUT_SECONDS, SIGNALS_TOTAL, OUTBOUND_EVICTIONS,
+    HEARTBEAT_EVICTIONS
+)
+from config import (
+    MATCH_TICK_INTERVAL, SESSION_DURATION, STATS_MAX_AGE, STATS_PUSH_INTERVAL,
+    PAGE_SIZE, PAGE_SIZE_MAX, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+    BACKPLANE_URL, WORKER_ID, COORDINATOR_TTL_MS
+)
+from auth import (
+    verify_password_async, get_password_hash_async, create_access_token,
+    verify_token_cached, token_claims, HashingBusy
+)
 
 app = FastAPI(title="Video Dating App")
 
@@ -28,121 +53,459 @@ app.add_middleware(
 # Монтируем статические файлы
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+@app.exception_handler(HashingBusy)
+async def hashing_busy_handler(request: Request, exc: HashingBusy):
+    # Пул argon2 переполнен - просим клиента повторить позже
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Сервер перегружен, попробуйте позже"},
+        headers={"Retry-After": "1"}
+    )
+
 # In-memory хранилище для активных сессий
-waiting_users = []
-active_timers = {}
+# Недавние собеседники, которых не подбираем друг другу повторно
+recent_partners = RecentPartners()
+waiting_users = ShardedMatchQueue(recent=recent_partners)
+active_timers = TimerWheel()
+active_sessions = SessionRegistry()
+presence = PresenceTracker()
+app_stats = AppStats()
+
+# Шина между воркерами. Очередь поиска, сессии и таймеры живут только у
+# воркера-координатора; остальные пересылают ему события пользователей.
+backplane = create_backplane(BACKPLANE_URL)
+COORDINATOR_KEY = "chatminute:coordinator"
+COORDINATOR_CHANNEL = "coordinator"
+# Канал, в который каждый воркер публикует свои текущие значения статистики
+STATS_CHANNEL = "stats"
+# Канал сброса закэшированной строки пользователя на всех воркерах
+USER_INVALIDATE_CHANNEL = "user_invalidate"
+# События, которые меняют общее состояние и обрабатываются координатором
+COORDINATED_MESSAGES = {"start_search", "stop_search", "approve", "reject", "disconnect"}
+is_coordinator = False
+# Типы сообщений клиента - метки метрик (остальные считаются как "other")
+KNOWN_MESSAGES = COORDINATED_MESSAGES | SIGNAL_MESSAGES | {"subscribe_stats", "unsubscribe_stats", "pong"}
+# Проверка, что клиент жив; ответ - любое сообщение, обычно {"type": "pong"}
+PING_FRAME = dumps({"type": "ping"})
+
+class Connection:
+    """Подключенный к этому воркеру пользователь"""
+    
+    __slots__ = ('user_id', 'websocket', 'connected_at', 'last_seen', 'outbox', 'writer', 'partner_id')
+    
+    def __init__(self, user_id: int, websocket: WebSocket):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.connected_at = asyncio.get_running_loop().time()
+        # Время последнего входящего сообщения (для heartbeat)
+        self.last_seen = self.connected_at
+        # Исходящие кадры отправляет задача-писатель, а не обработчик
+        self.outbox = OutboundQueue()
+        self.writer: Optional[asyncio.Task] = None
+        # Текущий собеседник: только ему можно пересылать WebRTC сигналы
+        self.partner_id: Optional[int] = None
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+        self.active_connections: Dict[int, Connection] = {}
+        # Пользователи этого воркера, подписанные на статистику
+        self.stats_subscribers: Set[int] = set()
     
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def connect(self, websocket: WebSocket, user_id: int) -> Connection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        previous = self.active_connections.get(user_id)
+        if previous:
+            self._stop_writer(previous)
+        connection = self.active_connections[user_id] = Connection(user_id, websocket)
+        connection.writer = asyncio.create_task(self._write_loop(connection))
+        
+        # Сообщения для пользователя с других воркеров
+        await backplane.subscribe(user_channel(user_id))
         
-        # Обновляем статус пользователя в БД
-        db.update_user_online_status(user_id, True)
+        # Статус попадет в БД при следующем сбросе presence
+        presence.set_online(user_id, True)
+        return connection
     
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    async def disconnect(self, user_id: int):
+        self.stats_subscribers.discard(user_id)
+        connection = self.active_connections.pop(user_id, None)
+        if connection:
+            self._stop_writer(connection)
+            await backplane.unsubscribe(user_channel(user_id))
         
-        # Обновляем статус пользователя в БД
-        db.update_user_online_status(user_id, False)
+        presence.set_online(user_id, False)
+    
+    def _stop_writer(self, connection: Connection):
+        connection.outbox.clear()
+        if connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+    
+    async def _write_loop(self, connection: Connection):
+        """Задача-писатель: отправляет кадры из очереди соединения по одному"""
+        try:
+            while True:
+                frame = await connection.outbox.pop()
+                await connection.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Сокет закрыт - убираем соединение, если его еще не заменило новое
+            if self.active_connections.get(connection.user_id) is connection:
+                await self.disconnect(connection.user_id)
+    
+    async def _evict(self, connection: Connection):
+        """Отключить клиента, который не успевает принимать сообщения"""
+        OUTBOUND_EVICTIONS.inc()
+        print(f"Evicting slow consumer {connection.user_id}")
+        # Пользователь мог уже переподключиться
+        if connection.user_id not in self.active_connections:
+            self.stats_subscribers.discard(connection.user_id)
+            presence.set_online(connection.user_id, False)
+            await backplane.unsubscribe(user_channel(connection.user_id))
+        # Кадр закрытия медленному клиенту может уходить долго - не ждем его
+        asyncio.create_task(self.close(connection, 1013))
+    
+    async def close(self, connection: Connection, code: int):
+        """Закрыть сокет, не дожидаясь ответа клиента"""
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass
+    
+    def heartbeat(self) -> List[Connection]:
+        """Пинг простаивающих соединений. Возвращает молчащие дольше HEARTBEAT_TIMEOUT"""
+        now = asyncio.get_running_loop().time()
+        idle, stale = [], []
+        for connection in self.active_connections.values():
+            silence = now - connection.last_seen
+            if silence >= HEARTBEAT_TIMEOUT:
+                stale.append(connection)
+            elif silence >= HEARTBEAT_INTERVAL:
+                idle.append(connection.user_id)
+        self.broadcast_text(PING_FRAME, idle, "ping")
+        return stale
+    
+    def _deliver(self, message: dict, frame: str, user_id: int):
+        """Поставить сообщение в очередь локального пользователя и обновить его комнату"""
+        kind = message.get("type")
+        if kind in ROOM_EVENTS:
+            self.active_connections[user_id].partner_id = message.get("partner_id")
+        self.enqueue(frame, user_id, kind)
+    
+    def leave_room(self, user_id: int):
+        connection = self.active_connections.get(user_id)
+        if connection:
+            connection.partner_id = None
+    
+    def enqueue(self, text: str, user_id: int, kind: Optional[str] = None):
+        """Поставить сериализованный кадр в очередь подключенного пользователя"""
+        connection = self.active_connections.get(user_id)
+        if connection and not connection.outbox.push(text, kind):
+            # Дальнейшие сообщения этому соединению уже не нужны
+            del self.active_connections[user_id]
+            self._stop_writer(connection)
+            asyncio.create_task(self._evict(connection))
+    
+    async def send_local(self, message: dict, user_id: int):
+        """Отправить сообщение, если пользователь подключен к этому воркеру"""
+        if user_id in self.active_connections:
+            self._deliver(message, dumps(message), user_id)
     
     async def send_personal_message(self, message: dict, user_id: int):
         if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json(message)
-            except:
-                self.disconnect(user_id)
+            self._deliver(message, dumps(message), user_id)
+        else:
+            # Пользователь может быть подключен к другому воркеру
+            await backplane.publish(user_channel(user_id), message)
+    
+    async def broadcast(self, message: dict, user_ids: Iterable[int]):
+        """Отправить одно сообщение нескольким пользователям.
+
+        Сообщение сериализуется один раз и ставится в очереди соединений, так
+        что медленный сокет не задерживает остальных. Пользователям других
+        воркеров сообщение уходит через шину.
+        """
+        frame = None
+        remote = []
+        for user_id in user_ids:
+            if user_id in self.active_connections:
+                if frame is None:
+                    frame = dumps(message)
+                self._deliver(message, frame, user_id)
+            else:
+                remote.append(backplane.publish(user_channel(user_id), message))
+        if remote:
+            await asyncio.gather(*remote)
+    
+    def broadcast_text(self, text: str, user_ids: Iterable[int], kind: Optional[str] = None):
+        """Разослать одно сериализованное сообщение локальным пользователям"""
+        for user_id in list(user_ids):
+            self.enqueue(text, user_id, kind)
+    
+    async def subscribe_stats(self, user_id: int):
+        """Подписать на статистику и сразу отправить текущие значения"""
+        self.stats_subscribers.add(user_id)
+        _, frame = app_stats.frame()
+        self.enqueue(frame, user_id, "stats")
+    
+    def outbound_stats(self, top: int = 10) -> dict:
+        """Глубина исходящих очередей: сумма, максимум и самые длинные"""
+        depths = [(len(c.outbox), user_id) for user_id, c in self.active_connections.items()]
+        deepest = heapq.nlargest(top, depths)
+        return {
+            "queued": sum(depth for depth, _ in depths),
+            "max_depth": max(depths)[0] if depths else 0,
+            "deepest": {user_id: depth for depth, user_id in deepest if depth}
+        }
+    
+    async def send_many(self, messages: List[tuple]):
+        """Отправить пачку сообщений [(message, user_id), ...] одновременно"""
+        await asyncio.gather(*(
+            self.send_personal_message(message, user_id) for message, user_id in messages
+        ))
 
 manager = ConnectionManager()
 
-# Зависимость для аутентификации
-async def get_current_user(request: Request):
+async def send_candidates(from_user_id: int, target_user_id: int, candidates: List[dict]):
+    await manager.send_personal_message({
+        "type": "ice_candidates",
+        "candidates": candidates,
+        "from_user_id": from_user_id
+    }, target_user_id)
+
+candidate_batcher = CandidateBatcher(send_candidates)
+signal_log = SampledLog()
+
+# Текущие значения статистики берутся из памяти при запросе и суммируются
+# по воркерам: онлайн у каждого свой, сессии и очередь - только у координатора
+app_stats.track('online_users', lambda: presence.online_count)
+app_stats.track('active_sessions', lambda: len(active_sessions))
+app_stats.track('waiting_users', lambda: len(waiting_users))
+
+# Gauge читаются только при запросе /metrics
+registry.gauge('chatminute_waiting_users', 'Пользователи в очереди поиска', lambda: len(waiting_users))
+registry.gauge('chatminute_match_shards', 'Непустые шарды очереди поиска', lambda: waiting_users.shard_count)
+registry.gauge('chatminute_recent_partner_pairs', 'Пары в фильтре недавних собеседников', lambda: len(recent_partners))
+registry.gauge('chatminute_recent_partner_bytes', 'Память фильтра недавних собеседников', lambda: recent_partners.memory_bytes)
+registry.gauge('chatminute_recent_partner_false_positive_rate', 'Оценка доли ложных срабатываний фильтра недавних собеседников', recent_partners.false_positive_rate)
+registry.gauge('chatminute_connections', 'WebSocket соединения этого воркера', lambda: len(manager.active_connections))
+registry.gauge('chatminute_outbound_queued_frames', 'Кадры в исходящих очередях всех соединений', lambda: manager.outbound_stats(0)["queued"])
+registry.gauge('chatminute_outbound_queue_max_depth', 'Самая длинная исходящая очередь', lambda: manager.outbound_stats(1)["max_depth"])
+registry.gauge('chatminute_active_sessions', 'Идущие сессии матча', lambda: len(active_sessions))
+registry.gauge('chatminute_session_timers', 'Запланированные таймеры сессий', lambda: len(active_timers))
+registry.gauge('chatminute_is_coordinator', 'Воркер - координатор', lambda: int(is_coordinator))
+
+# Зависимости для аутентификации
+async def get_token_payload(request: Request) -> Optional[dict]:
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         return None
     
     token = auth_header[7:]
-    payload = verify_token(token)
+    return verify_token_cached(token)
+
+async def get_current_claims(payload: Optional[dict] = Depends(get_token_payload)):
+    """Данные из токена (id, gender, age) без обращения к БД"""
+    if not payload:
+        return None
+    
+    return {
+        "id": int(payload.get("sub")),
+        "gender": payload.get("gender"),
+        "age": payload.get("age")
+    }
+
+async def get_current_user(payload: Optional[dict] = Depends(get_token_payload)):
     if not payload:
         return None
     
     user_id = int(payload.get("sub"))
-    user = db.get_user_by_id(user_id)
+    user = await adb.get_user_by_id(user_id)
     return user
 
 # Вспомогательные функции
-def calculate_distance(lat1, lng1, lat2, lng2):
-    """Упрощенный расчет расстояния"""
-    return math.sqrt((lat1 - lat2)**2 + (lng1 - lng2)**2)
+async def run_matching_round():
+    """Один раунд подбора пар по всей очереди ожидания"""
+    if len(waiting_users) < 2:
+        return
 
-def find_best_match(current_user_data):
-    """Найти лучшего собеседника"""
-    if not waiting_users:
-        return None
-    
-    best_match = None
-    best_score = float('inf')
-    
-    for candidate in waiting_users:
-        if candidate['user_id'] == current_user_data['user_id']:
-            continue
-        
-        candidate_user = db.get_user_by_id(candidate['user_id'])
-        if not candidate_user:
-            continue
-        
-        # Проверяем противоположный пол
-        if candidate['gender'] == current_user_data['gender']:
-            continue
-        
-        # Проверяем разницу в возрасте (максимум 10 лет)
-        age_diff = abs(candidate['age'] - current_user_data['age'])
-        if age_diff > 10:
+    # Матрицы стоимости считаются в потоках, чтобы не блокировать цикл событий
+    with MATCH_ROUND_SECONDS.time():
+        pairs = await waiting_users.pair_round()
+
+    if pairs:
+        now = time.monotonic()
+        for u1, u2 in pairs:
+            MATCH_WAIT_SECONDS.observe(now - u1.enqueued_at)
+            MATCH_WAIT_SECONDS.observe(now - u2.enqueued_at)
+        await create_match_sessions([(u1.user_id, u2.user_id) for u1, u2 in pairs])
+        MATCHES_TOTAL.inc(amount=len(pairs))
+
+async def matching_loop():
+    """Фоновая задача: периодические раунды подбора пар"""
+    while True:
+        await asyncio.sleep(MATCH_TICK_INTERVAL)
+        if not is_coordinator:
             continue
-        
-        # Рассчитываем расстояние и score
-        distance = calculate_distance(
-            current_user_data['location'][0], current_user_data['location'][1],
-            candidate['location'][0], candidate['location'][1]
-        )
-        
-        score = distance + age_diff * 5
-        
-        if score < best_score:
-            best_score = score
-            best_match = candidate
+        try:
+            await run_matching_round()
+        except Exception as e:
+            print(f"Matching round error: {e}")
+
+async def stats_loop():
+    """Фоновая задача: рассылка статистики подписчикам при изменении"""
+    last_etag = None
+    while True:
+        await asyncio.sleep(STATS_PUSH_INTERVAL)
+        try:
+            if BACKPLANE_URL:
+                await backplane.publish(STATS_CHANNEL, {"worker": WORKER_ID, "values": app_stats.local_values()})
+            if not manager.stats_subscribers:
+                continue
+            etag, frame = app_stats.frame()
+            if etag != last_etag:
+                last_etag = etag
+                manager.broadcast_text(frame, manager.stats_subscribers, "stats")
+        except Exception as e:
+            print(f"Stats broadcast error: {e}")
+
+async def heartbeat_loop():
+    """Фоновая задача: пинг простаивающих соединений и отключение мертвых"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            for connection in manager.heartbeat():
+                await reap_connection(connection)
+        except Exception as e:
+            print(f"Heartbeat error: {e}")
+
+async def reap_connection(connection: Connection):
+    """Отключить соединение, которое не отвечает на ping (полуоткрытый сокет)"""
+    user_id = connection.user_id
+    if manager.active_connections.get(user_id) is not connection:
+        return
+    HEARTBEAT_EVICTIONS.inc()
+    print(f"Reaping dead connection {user_id}")
+    await manager.disconnect(user_id)
+    # Координатор уберет пользователя из очереди и завершит его сессию
+    await backplane.publish(COORDINATOR_CHANNEL, {"user_id": user_id, "data": {"type": "connection_lost"}})
+    # Закрытие будит обработчик, ждущий receive_text
+    asyncio.create_task(manager.close(connection, 1001))
+
+async def elect_coordinator():
+    """Захватить или продлить роль координатора"""
+    global is_coordinator
+    try:
+        acquired = await backplane.try_acquire(COORDINATOR_KEY, WORKER_ID, COORDINATOR_TTL_MS)
+    except BackplaneUnavailable as e:
+        # Не продлили роль - ее может забрать другой воркер, пока шина недоступна
+        print(f"Coordinator election error: {e}")
+        acquired = False
+    if acquired and not is_coordinator:
+        await backplane.subscribe(COORDINATOR_CHANNEL)
+        print(f"Worker {WORKER_ID} is now the coordinator")
+    elif not acquired and is_coordinator:
+        await backplane.unsubscribe(COORDINATOR_CHANNEL)
+        print(f"Worker {WORKER_ID} lost the coordinator role")
+    is_coordinator = acquired
+
+async def coordinator_loop():
+    """Фоновая задача: продление роли координатора"""
+    while True:
+        await asyncio.sleep(COORDINATOR_TTL_MS / 3000)
+        try:
+            await elect_coordinator()
+        except Exception as e:
+            print(f"Coordinator election error: {e}")
+
+async def on_backplane_message(channel: str, message: dict):
+    """Сообщение из шины: событие для координатора или сообщение пользователю"""
+    if channel == COORDINATOR_CHANNEL:
+        await handle_coordinated_message(message["data"], message["user_id"])
+    elif channel == STATS_CHANNEL:
+        if message["worker"] != WORKER_ID:
+            app_stats.worker_values(message["worker"], message["values"])
+    elif channel == USER_INVALIDATE_CHANNEL:
+        db.user_cache.invalidate(message["user_id"])
+    else:
+        await manager.send_local(message, int(channel.split(":", 1)[1]))
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # После перезапуска онлайн никого нет - источник истины теперь в памяти
+    if not BACKPLANE_URL:
+        await adb.reset_online_status()
+    await app_stats.reconcile(adb)
+    # Пары из сессий, завершенных до перезапуска
+    for row in await adb.get_recent_pairs(recent_partners.ttl):
+        recent_partners.add(row['user1_id'], row['user2_id'], max(0.0, row['age']))
+    await backplane.start(on_backplane_message)
+    if BACKPLANE_URL:
+        await backplane.subscribe(STATS_CHANNEL)
+        await backplane.subscribe(USER_INVALIDATE_CHANNEL)
+    await elect_coordinator()
+    asyncio.create_task(coordinator_loop())
+    asyncio.create_task(presence.run(adb))
+    asyncio.create_task(app_stats.run(adb))
+    asyncio.create_task(stats_loop())
+    asyncio.create_task(active_timers.run())
+    asyncio.create_task(matching_loop())
+    asyncio.create_task(heartbeat_loop())
+
+@app.on_event("shutdown")
+async def shutdown_database():
+    # Дописываем оставшиеся запросы в БД
+    await presence.flush(adb)
+    await backplane.close()
+    await asyncio.to_thread(adb.shutdown)
+
+def persist_session(session: MatchSession):
+    """Записать завершенную сессию в БД в фоне"""
+    async def save():
+        try:
+            await adb.save_match_session(session.to_row())
+        except Exception as e:
+            print(f"Error saving session {session.id}: {e}")
     
-    return best_match
+    asyncio.create_task(save())
 
-async def start_session_timer(session_id: str, room_id: str, user1_id: int, user2_id: int):
-    """Запустить таймер сессии"""
-    await asyncio.sleep(60)  # 1 минута
+async def expire_session(session_id: str):
+    """Время сессии вышло (вызывается колесом таймеров)"""
+    # Сессия могла уже завершиться взаимным лайком или отказом
+    session = active_sessions.get(session_id)
+    if not session or not active_sessions.finish(session, EXPIRED):
+        return
     
-    # Проверяем, существует ли еще сессия
-    session = db.get_match_session_by_room(room_id)
-    if not session or session.get('ended_at'):
+    persist_session(session)
+    
+    # Уведомляем пользователей
+    await manager.broadcast({
+        "type": "time_expired",
+        "message": "Время вышло! Продолжаем поиск..."
+    }, (session.user1_id, session.user2_id))
+
+async def end_session_of(user_id: int):
+    """Завершить активную сессию отключившегося пользователя и вернуть собеседника к поиску"""
+    session = active_sessions.get_by_user(user_id)
+    if not session or not active_sessions.finish(session, REJECTED):
         return
     
-    # Если время вышло и нет mutual like - завершаем сессию
-    if not (session['user1_approval'] and session['user2_approval']):
-        db.complete_match_session(session_id, False)
-        
-        # Уведомляем пользователей
-        await manager.send_personal_message({
-            "type": "time_expired",
-            "message": "Время вышло! Продолжаем поиск..."
-        }, user1_id)
-        
-        await manager.send_personal_message({
-            "type": "time_expired", 
-            "message": "Время вышло! Продолжаем поиск..."
-        }, user2_id)
+    active_timers.cancel(session.id)
+    persist_session(session)
+    
+    await manager.send_personal_message({
+        "type": "match_rejected",
+        "message": "Собеседник отключился"
+    }, session.partner_of(user_id))
 
 # API endpoints
+def normalize_gender(gender) -> str:
+    """Пол из формы: одно из GENDERS, иначе 400"""
+    normalized = str(gender).strip().lower()
+    if normalized not in GENDERS:
+        raise HTTPException(status_code=400, detail="Недопустимое значение пола")
+    return normalized
+
 @app.post("/api/register")
 async def register(
     username: str = Form(...),
@@ -157,8 +520,10 @@ async def register(
     location_lat: float = Form(55.7558),
     location_lng: float = Form(37.6173)
 ):
+    gender = normalize_gender(gender)
+    
     # Проверяем, не существует ли пользователь
-    existing_user = db.get_user_by_username(username)
+    existing_user = await adb.get_user_by_username(username)
     if existing_user:
         raise HTTPException(
             status_code=400,
@@ -166,7 +531,7 @@ async def register(
         )
     
     if email:
-        existing_email = db.get_user_by_email(email)
+        existing_email = await adb.get_user_by_email(email)
         if existing_email:
             raise HTTPException(
                 status_code=400,
@@ -177,7 +542,7 @@ async def register(
     user_data = {
         'username': username,
         'email': email,
-        'password_hash': get_password_hash(password),
+        'password_hash': await get_password_hash_async(password),
         'first_name': first_name,
         'last_name': last_name,
         'age': age,
@@ -188,12 +553,13 @@ async def register(
         'location_lng': location_lng
     }
     
-    user_id = db.create_user(user_data)
-    user = db.get_user_by_id(user_id)
+    user_id = await adb.create_user(user_data)
+    app_stats.user_created()
+    user = await adb.get_user_by_id(user_id)
     
     # Создаем токен
     access_token = create_access_token(
-        data={"sub": str(user_id)},
+        data=token_claims(user),
         expires_delta=timedelta(minutes=60 * 24 * 7)  # 7 дней
     )
     
@@ -215,8 +581,8 @@ async def login(
     username: str = Form(...),
     password: str = Form(...)
 ):
-    user = db.get_user_by_username(username)
-    if not user or not verify_password(password, user['password_hash']):
+    user = await adb.get_user_by_username(username)
+    if not user or not await verify_password_async(password, user['password_hash']):
         raise HTTPException(
             status_code=401,
             detail="Неверное имя пользователя или пароль"
@@ -224,7 +590,7 @@ async def login(
     
     # Создаем токен
     access_token = create_access_token(
-        data={"sub": str(user['id'])},
+        data=token_claims(user),
         expires_delta=timedelta(minutes=60 * 24 * 7)  # 7 дней
     )
     
@@ -257,29 +623,38 @@ async def get_profile(current_user: dict = Depends(get_current_user)):
         "bio": current_user['bio'],
         "interests": current_user['interests'],
         "location_lat": current_user['location_lat'],
-        "location_lng": currentUser['location_lng'],
-        "is_online": bool(current_user['is_online']),
+        "location_lng": current_user['location_lng'],
+        "is_online": presence.is_online(current_user['id']),
         "last_seen": current_user['last_seen']
     }
 
 @app.put("/api/profile")
 async def update_profile(
     request: Request,
-    current_user: dict = Depends(get_current_user)
+    claims: dict = Depends(get_current_claims)
 ):
-    if not current_user:
+    if not claims:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     update_data = await request.json()
+    if 'gender' in update_data:
+        update_data['gender'] = normalize_gender(update_data['gender'])
     
     # Обновляем пользователя
-    db.update_user(current_user['id'], update_data)
+    await adb.update_user(claims['id'], update_data)
+    if BACKPLANE_URL:
+        # Кэш сброшен только у этого воркера; координатор подбирает пары по
+        # строке из своего кэша, поэтому сбрасываем ее у всех
+        try:
+            await backplane.publish(USER_INVALIDATE_CHANNEL, {"user_id": claims['id']})
+        except BackplaneUnavailable as e:
+            print(f"User cache invalidation error: {e}")
     
     return {"status": "success", "message": "Профиль обновлен"}
 
 @app.get("/api/user/{user_id}")
 async def get_user(user_id: int):
-    user = db.get_user_by_id(user_id)
+    user = await adb.get_user_by_id(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -293,6 +668,78 @@ async def get_user(user_id: int):
         "bio": user['bio']
     }
 
+# Постраничная история: курсор - непрозрачная строка из (время, id) последней строки страницы
+def encode_cursor(timestamp: str, row_id) -> str:
+    return base64.urlsafe_b64encode(dumps([timestamp, row_id]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, id_type: type) -> tuple:
+    try:
+        timestamp, row_id = loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(timestamp, str) and isinstance(row_id, id_type):
+            return timestamp, row_id
+    except Exception:
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def partner_profile(row: dict) -> dict:
+    return {
+        "id": row['partner_id'],
+        "first_name": row['first_name'],
+        "last_name": row['last_name'],
+        "age": row['age'],
+        "gender": row['gender'],
+        "bio": row['bio']
+    }
+
+@app.get("/api/connections")
+async def get_connections(
+    cursor: Optional[str] = None,
+    limit: int = PAGE_SIZE,
+    claims: dict = Depends(get_current_claims)
+):
+    """Связи пользователя (взаимные лайки), от новых к старым"""
+    if not claims:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    before = decode_cursor(cursor, int) if cursor else None
+    rows = await adb.get_connections_page(claims['id'], before, limit)
+    
+    return {
+        "items": [{
+            "id": row['id'],
+            "matched_at": row['matched_at'],
+            "is_active": bool(row['is_active']),
+            "partner": partner_profile(row)
+        } for row in rows],
+        "next_cursor": encode_cursor(rows[-1]['matched_at'], rows[-1]['id']) if len(rows) == limit else None
+    }
+
+@app.get("/api/history")
+async def get_history(
+    cursor: Optional[str] = None,
+    limit: int = PAGE_SIZE,
+    claims: dict = Depends(get_current_claims)
+):
+    """Завершенные сессии пользователя, от новых к старым"""
+    if not claims:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    before = decode_cursor(cursor, str) if cursor else None
+    rows = await adb.get_history_page(claims['id'], before, limit)
+    
+    return {
+        "items": [{
+            "id": row['id'],
+            "started_at": row['started_at'],
+            "ended_at": row['ended_at'],
+            "is_matched": bool(row['is_matched']),
+            "partner": partner_profile(row)
+        } for row in rows],
+        "next_cursor": encode_cursor(rows[-1]['started_at'], rows[-1]['id']) if len(rows) == limit else None
+    }
+
 # WebSocket endpoint с аутентификацией
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int, token: str = None):
@@ -301,27 +748,60 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, token: str = No
         await websocket.close(code=1008)
         return
     
-    payload = verify_token(token)
+    payload = verify_token_cached(token)
     if not payload or int(payload.get("sub")) != user_id:
         await websocket.close(code=1008)
         return
     
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
+    loop = asyncio.get_running_loop()
     
     try:
         while True:
-            data = await websocket.receive_json()
-            await handle_websocket_message(data, user_id)
+            raw = await websocket.receive_text()
+            connection.last_seen = loop.time()
+            data = loads(raw)
+            start = time.perf_counter()
+            message_type = data.get("type")
+            try:
+                if message_type in SIGNAL_MESSAGES:
+                    await relay_signal(raw, data, user_id)
+                else:
+                    await handle_websocket_message(data, user_id)
+            except BackplaneUnavailable as e:
+                # Сообщение теряется, но соединение не рвем: шина переподключится
+                print(f"Dropped {message_type} from {user_id}: {e}")
+            WS_MESSAGE_SECONDS.observe(
+                time.perf_counter() - start,
+                message_type if message_type in KNOWN_MESSAGES else "other"
+            )
     
     except WebSocketDisconnect:
-        await handle_disconnect(user_id)
+        await handle_disconnect(user_id, connection)
     except Exception as e:
         print(f"WebSocket error: {e}")
-        await handle_disconnect(user_id)
+        await handle_disconnect(user_id, connection)
 
 async def handle_websocket_message(data: dict, user_id: int):
     message_type = data.get("type")
     
+    if message_type in COORDINATED_MESSAGES:
+        if message_type == "reject":
+            # Отказавшийся больше не шлет сигналы бывшему собеседнику
+            manager.leave_room(user_id)
+        # Очередь и сессии ведет координатор (в одном процессе - мы сами)
+        await backplane.publish(COORDINATOR_CHANNEL, {"user_id": user_id, "data": data})
+            
+    elif message_type == "subscribe_stats":
+        await manager.subscribe_stats(user_id)
+            
+    elif message_type == "unsubscribe_stats":
+        manager.stats_subscribers.discard(user_id)
+
+async def handle_coordinated_message(data: dict, user_id: int):
+    """События, которые обрабатывает координатор"""
+    message_type = data.get("type")
+    
     if message_type == "start_search":
         await handle_start_search(data, user_id)
             
@@ -334,163 +814,181 @@ async def handle_websocket_message(data: dict, user_id: int):
     elif message_type == "reject":
         await handle_reject(data, user_id)
             
-    elif message_type == "webrtc_offer":
-        await handle_webrtc_signal(data, user_id, "offer")
+    elif message_type == "disconnect":
+        # Удаляем из очереди ожидания
+        waiting_users.remove(user_id)
             
-    elif message_type == "webrtc_answer":
-        await handle_webrtc_signal(data, user_id, "answer")
-            
-    elif message_type == "ice_candidate":
-        await handle_webrtc_signal(data, user_id, "candidate")
+    elif message_type == "connection_lost":
+        # Соединение не отвечало на ping (только от воркеров, клиент это не пришлет)
+        waiting_users.remove(user_id)
+        await end_session_of(user_id)
 
 async def handle_start_search(data: dict, user_id: int):
     """Обработка начала поиска"""
-    user = db.get_user_by_id(user_id)
+    user = await adb.get_user_by_id(user_id)
     if not user:
         return
-    
-    user_data = {
-        'user_id': user_id,
-        'gender': user['gender'],
-        'age': user['age'],
-        'location': (user['location_lat'], user['location_lng'])
-    }
+    if user['gender'] not in GENDERS:
+        # Строки, записанные до проверки пола, в пул не попадают
+        print(f"User {user_id} has unsupported gender {user['gender']!r}, search ignored")
+        return
     
     # Добавляем в очередь поиска
-    if not any(u['user_id'] == user_id for u in waiting_users):
-        waiting_users.append(user_data)
+    waiting_users.add(Waiter(user_id, user['gender'], user['age'], user['location_lat'], user['location_lng']))
     
     await manager.send_personal_message({
         "type": "search_started",
         "message": "Поиск собеседника начат..."
     }, user_id)
     
-    # Ищем матч
-    matched_user = find_best_match(user_data)
-    
-    if matched_user:
-        await create_match_session(user_id, matched_user['user_id'])
-    else:
-        await manager.send_personal_message({
-            "type": "searching",
-            "message": "Ищем подходящего собеседника..."
-        }, user_id)
+    # Пара подбирается в ближайшем раунде matching_loop
+    await manager.send_personal_message({
+        "type": "searching",
+        "message": "Ищем подходящего собеседника..."
+    }, user_id)
 
 async def handle_stop_search(user_id: int):
     """Обработка остановки поиска"""
     # Удаляем из очереди ожидания
-    waiting_users[:] = [u for u in waiting_users if u['user_id'] != user_id]
+    waiting_users.remove(user_id)
     
     await manager.send_personal_message({
         "type": "search_stopped",
         "message": "Поиск остановлен"
     }, user_id)
 
-async def create_match_session(user1_id: int, user2_id: int):
-    """Создать сессию матча"""
-    room_id = str(uuid.uuid4())
-    session_id = str(uuid.uuid4())
+async def create_match_sessions(pairs: List[tuple]):
+    """Создать сессии матча для пачки пар [(user1_id, user2_id), ...]"""
+    notifications = []
+    deadline = asyncio.get_running_loop().time() + SESSION_DURATION
     
-    db.create_match_session(user1_id, user2_id, room_id, session_id)
-    
-    # Удаляем из очереди ожидания
-    waiting_users[:] = [u for u in waiting_users if u['user_id'] not in [user1_id, user2_id]]
-    
-    # Запускаем таймер
-    asyncio.create_task(start_session_timer(session_id, room_id, user1_id, user2_id))
-    
-    # Уведомляем обоих пользователей
-    await manager.send_personal_message({
-        "type": "match_found",
-        "room_id": room_id,
-        "partner_id": user2_id,
-        "message": "Собеседник найден! Подготовка к видеозвонку..."
-    }, user1_id)
+    for user1_id, user2_id in pairs:
+        # Сессия живет в памяти и попадет в БД после завершения
+        session = active_sessions.create(user1_id, user2_id, deadline)
+        room_id = session.room_id
+        recent_partners.add(user1_id, user2_id)
+        
+        # Удаляем из очереди ожидания
+        waiting_users.remove(user1_id)
+        waiting_users.remove(user2_id)
+        
+        # Запускаем таймер
+        active_timers.schedule(session.id, SESSION_DURATION, expire_session, session.id)
+        
+        notifications.append(({
+            "type": "match_found",
+            "room_id": room_id,
+            "partner_id": user2_id,
+            "duration": SESSION_DURATION,
+            "message": "Собеседник найден! Подготовка к видеозвонку..."
+        }, user1_id))
+        notifications.append(({
+            "type": "match_found",
+            "room_id": room_id,
+            "partner_id": user1_id,
+            "duration": SESSION_DURATION,
+            "message": "Собеседник найден! Подготовка к видеозвонку..."
+        }, user2_id))
     
-    await manager.send_personal_message({
-        "type": "match_found",
-        "room_id": room_id,
-        "partner_id": user1_id,
-        "message": "Собеседник найден! Подготовка к видеозвонку..."
-    }, user2_id)
+    # Уведомляем всех пользователей раунда одной пачкой
+    await manager.send_many(notifications)
 
 async def handle_approve(data: dict, user_id: int):
     """Обработка одобрения собеседника"""
     room_id = data.get("room_id")
     
-    session = db.get_match_session_by_room(room_id)
+    session = active_sessions.get_by_room(room_id)
     if not session:
         return
     
-    db.update_match_session_approval(session['id'], user_id, True)
-    
-    # Проверяем mutual like
-    session_updated = db.get_match_session_by_room(room_id)
-    if session_updated['user1_approval'] and session_updated['user2_approval']:
-        await handle_mutual_match(session_updated)
+    # Одобрение и проверка mutual like - одна атомарная операция
+    if active_sessions.approve(session, user_id):
+        await handle_mutual_match(session)
 
-async def handle_mutual_match(session: dict):
+async def handle_mutual_match(session: MatchSession):
     """Обработка взаимного согласия - НЕ разрываем соединение"""
-    db.complete_match_session(session['id'], True)
-    db.create_connection(session['user1_id'], session['user2_id'])
+    if not active_sessions.finish(session, MATCHED):
+        return
+    
+    active_timers.cancel(session.id)
+    persist_session(session)
+    await adb.create_connection(session.user1_id, session.user2_id)
+    app_stats.match_created()
     
     # Уведомляем обоих пользователей о успешном матче
-    await manager.send_personal_message({
+    await manager.broadcast({
         "type": "match_success",
         "message": "🎉 Вы понравились друг другу! Теперь вы можете общаться дальше.",
-        "room_id": session['room_id']  # Важно: отправляем room_id для продолжения общения
-    }, session['user1_id'])
-    
-    await manager.send_personal_message({
-        "type": "match_success", 
-        "message": "🎉 Вы понравились друг другу! Теперь вы можете общаться дальше.",
-        "room_id": session['room_id']  # Важно: отправляем room_id для продолжения общения
-    }, session['user2_id'])
+        "room_id": session.room_id  # Важно: отправляем room_id для продолжения общения
+    }, (session.user1_id, session.user2_id))
 
 async def handle_reject(data: dict, user_id: int):
     """Обработка отклонения собеседника"""
     room_id = data.get("room_id")
     
-    session = db.get_match_session_by_room(room_id)
-    if not session:
+    session = active_sessions.get_by_room(room_id)
+    if not session or not session.has_user(user_id):
+        return
+    
+    if not active_sessions.finish(session, REJECTED):
         return
     
-    db.complete_match_session(session['id'], False)
+    active_timers.cancel(session.id)
+    persist_session(session)
     
     # Уведомляем другого пользователя
-    other_user_id = session['user2_id'] if session['user1_id'] == user_id else session['user1_id']
+    other_user_id = session.partner_of(user_id)
     await manager.send_personal_message({
         "type": "match_rejected",
         "message": "Собеседник решил продолжить поиск"
     }, other_user_id)
 
-async def handle_webrtc_signal(data: dict, user_id: int, signal_type: str):
-    """Обработка WebRTC сигналов"""
+async def relay_signal(raw: str, data: dict, user_id: int):
+    """Быстрый путь WebRTC сигналов: только собеседнику по комнате, без пересборки.
+
+    Offer и answer уходят исходным JSON с дописанным from_user_id, ICE
+    кандидаты склеиваются за короткое окно в один кадр ice_candidates.
+    """
+    message_type = data["type"]
     target_user_id = data.get("target_user_id")
-    if not target_user_id:
-        print(f"❌ No target_user_id in {signal_type} from {user_id}")
+    connection = manager.active_connections.get(user_id)
+    if connection is None or target_user_id is None or connection.partner_id != target_user_id:
+        SIGNALS_TOTAL.inc(message_type, "rejected")
+        signal_log("signal_rejected", type=message_type, from_user_id=user_id, target_user_id=target_user_id)
         return
     
-    message = {
-        "type": f"webrtc_{signal_type}",
-        signal_type: data.get(signal_type),
-        "from_user_id": user_id
-    }
-    
-    # Добавляем логирование для отладки
-    print(f"📨 WebRTC {signal_type} from {user_id} to {target_user_id}")
+    if message_type == "ice_candidate":
+        candidate_batcher.add(user_id, target_user_id, data.get("candidate"))
+        SIGNALS_TOTAL.inc(message_type, "batched")
+        return
     
+    # Кандидаты, собранные до этого сигнала, должны прийти раньше него
+    await candidate_batcher.flush(user_id, target_user_id)
     try:
-        await manager.send_personal_message(message, target_user_id)
-        print(f"✅ WebRTC {signal_type} delivered to {target_user_id}")
+        with SIGNAL_FANOUT_SECONDS.time(message_type):
+            if target_user_id in manager.active_connections:
+                manager.enqueue(with_sender(raw, user_id), target_user_id, message_type)
+            else:
+                # Собеседник на другом воркере
+                data["from_user_id"] = user_id
+                await backplane.publish(user_channel(target_user_id), data)
+        SIGNALS_TOTAL.inc(message_type, "relayed")
+        signal_log("signal_relayed", type=message_type, from_user_id=user_id, target_user_id=target_user_id)
     except Exception as e:
-        print(f"❌ Error sending WebRTC {signal_type}: {e}")
+        print(f"Error relaying {message_type} from {user_id}: {e}")
 
-async def handle_disconnect(user_id: int):
+async def handle_disconnect(user_id: int, connection: Optional[Connection] = None):
     """Обработка отключения пользователя"""
-    manager.disconnect(user_id)
-    # Удаляем из очереди ожидания
-    waiting_users[:] = [u for u in waiting_users if u['user_id'] != user_id]
+    current = manager.active_connections.get(user_id)
+    if connection is not None and current is not None and current is not connection:
+        # Пользователь уже переподключился - новое соединение не трогаем
+        return
+    await manager.disconnect(user_id)
+    # Координатор уберет пользователя из очереди ожидания
+    try:
+        await backplane.publish(COORDINATOR_CHANNEL, {"user_id": user_id, "data": {"type": "disconnect"}})
+    except BackplaneUnavailable as e:
+        print(f"Disconnect of {user_id} not forwarded: {e}")
 
 @app.get("/")
 async def read_root():
@@ -523,11 +1021,18 @@ async def read_root():
         return HTMLResponse(content=html_content)
 
 @app.get("/api/stats")
-async def get_stats():
-    """Получить статистику приложения"""
-    stats = db.get_stats()
-    stats['waiting_users'] = len(waiting_users)
-    return stats
+async def get_stats(request: Request):
+    """Получить статистику приложения (без запросов к БД)"""
+    etag, body = app_stats.snapshot()
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={STATS_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/health")
 async def health_check():
@@ -587,7 +1092,10 @@ async def debug_webrtc():
         "timestamp": datetime.now().isoformat(),
         "active_connections": len(manager.active_connections),
         "waiting_users": len(waiting_users),
-        "active_sessions": len([u for u in waiting_users if u.get('in_session')]),
+        "match_shards": waiting_users.shard_count,
+        "active_sessions": len(active_sessions),
+        "user_cache": db.user_cache.stats(),
+        "outbound_queues": manager.outbound_stats(),
         "server_info": {
             "python_version": os.sys.version,
             "platform": os.sys.platform
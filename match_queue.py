@@ -0,0 +1,308 @@
+import asyncio
+import math
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import (
+    MATCH_BATCH_LIMIT, MATCH_CANDIDATES_PER_USER, SHARD_CELL_SIZE, SHARD_WIDEN_AFTER,
+    SHARD_WIDEN_LIMIT, SHARD_WIDEN_BACKOFF_MAX
+)
+from matching import ScoringPool, PoolSnapshot, assign_across, assign_pairs, concat_snapshots, gender_name
+from metrics import MATCH_WIDEN_SECONDS
+from recent_partners import RecentPartners
+
+# Первая пауза (секунды) перед повторным поиском у соседей
+WIDEN_BACKOFF_START = 1.0
+
+
+def _grid_cell(lat: float, lng: float, cell_size: float) -> Tuple[int, int]:
+    return (
+        math.floor(lat / cell_size),
+        math.floor(lng / cell_size)
+    )
+
+
+def _ring(cx: int, cy: int, k: int) -> Iterator[Tuple[int, int]]:
+    """Ячейки на расстоянии ровно k (по Чебышёву) от (cx, cy)"""
+    if k == 0:
+        yield (cx, cy)
+        return
+    for dx in range(-k, k + 1):
+        yield (cx + dx, cy - k)
+        yield (cx + dx, cy + k)
+    for dy in range(-k + 1, k):
+        yield (cx - k, cy + dy)
+        yield (cx + k, cy + dy)
+
+
+class Waiter:
+    """Пользователь в очереди поиска"""
+
+    __slots__ = ('user_id', 'gender', 'age', 'lat', 'lng', 'enqueued_at')
+
+    def __init__(self, user_id: int, gender: str, age: int, lat: float, lng: float,
+                 enqueued_at: Optional[float] = None):
+        self.user_id = user_id
+        self.gender = gender
+        self.age = age
+        self.lat = lat
+        self.lng = lng
+        self.enqueued_at = time.monotonic() if enqueued_at is None else enqueued_at
+
+
+def pair_chunks(snapshots: List[PoolSnapshot], recent: Optional[RecentPartners] = None) -> List[Tuple[int, int]]:
+    """Пары user_id по всем частям снимка (выполняется в потоке)"""
+    pairs = []
+    for snapshot in snapshots:
+        pairs.extend(assign_pairs(snapshot, MATCH_CANDIDATES_PER_USER, recent))
+    return pairs
+
+
+def widen_chunks(tasks: List[Tuple[PoolSnapshot, PoolSnapshot]],
+                 recent: Optional[RecentPartners] = None) -> List[Tuple[int, int]]:
+    """Пары долго ждущих с ожидающими соседних шардов (выполняется в потоке)"""
+    with MATCH_WIDEN_SECONDS.time():
+        taken = set()
+        pairs = []
+        for waiting, neighbors in tasks:
+            pairs.extend(assign_across(waiting, neighbors, MATCH_CANDIDATES_PER_USER, recent, taken))
+        return pairs
+
+
+class MatchQueue:
+    """Очередь поиска поверх ScoringPool.
+
+    Координаты, возраст, пол и время постановки в очередь хранятся только
+    в массивах пула (для векторного подсчета score), а Waiter собирается
+    из них по запросу. Вставка и удаление - O(1). Недавние собеседники
+    (recent) друг другу не подбираются.
+    """
+
+    def __init__(self, recent: Optional[RecentPartners] = None):
+        self._pool = ScoringPool()
+        self.recent = recent
+
+    def __len__(self) -> int:
+        return len(self._pool)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._pool
+
+    def __iter__(self) -> Iterator[Waiter]:
+        """Ожидающие в порядке постановки в очередь"""
+        return iter([self.get(user_id) for user_id in self.waiting_since(math.inf)])
+
+    def get(self, user_id: int) -> Optional[Waiter]:
+        pool = self._pool
+        slot = pool.slot(user_id)
+        if slot is None:
+            return None
+        return Waiter(user_id, gender_name(int(pool.gender[slot])), int(pool.age[slot]),
+                      float(pool.lat[slot]), float(pool.lng[slot]), float(pool.enqueued_at[slot]))
+
+    def waiting_since(self, cutoff: float) -> List[int]:
+        """user_id вставших в очередь раньше cutoff, от самых давних"""
+        return self._pool.ids[self._pool.slots_since(cutoff)].tolist()
+
+    def snapshot(self, chunk_size: int = MATCH_BATCH_LIMIT) -> List[PoolSnapshot]:
+        """Копия очереди частями по chunk_size, от самых давних"""
+        slots = self._pool.slots_since()
+        return [
+            self._pool.snapshot_slots(slots[start:start + chunk_size])
+            for start in range(0, len(slots), chunk_size)
+        ]
+
+    def add(self, waiter: Waiter) -> bool:
+        """Добавить пользователя в очередь. False, если он уже в очереди"""
+        if waiter.user_id in self._pool:
+            return False
+        self._pool.append(waiter.user_id, waiter.gender, waiter.age, waiter.lat, waiter.lng, waiter.enqueued_at)
+        return True
+
+    def remove(self, user_id: int) -> Optional[Waiter]:
+        """Удалить пользователя из очереди"""
+        waiter = self.get(user_id)
+        if waiter is not None:
+            self._pool.remove(user_id)
+        return waiter
+
+    def snapshot_of(self, user_ids: List[int]) -> PoolSnapshot:
+        return self._pool.snapshot(user_ids)
+
+    def snapshot_all(self) -> PoolSnapshot:
+        return self._pool.snapshot_all()
+
+    def take_pairs(self, id_pairs: List[Tuple[int, int]]) -> List[Tuple[Waiter, Waiter]]:
+        """Забрать из очереди пары, посчитанные по снимку.
+
+        Пары, в которых кто-то уже покинул очередь, пропускаются.
+        """
+        pairs = []
+        for user1_id, user2_id in id_pairs:
+            if user1_id not in self._pool or user2_id not in self._pool:
+                continue
+            pairs.append((self.remove(user1_id), self.remove(user2_id)))
+        return pairs
+
+
+class ShardedMatchQueue:
+    """Очередь поиска, разбитая на географические шарды.
+
+    Шард - ячейка сетки SHARD_CELL_SIZE градусов со своей MatchQueue и
+    блокировкой. Раунды шардов считаются параллельно в потоках (NumPy
+    отпускает GIL); ожидающие дольше SHARD_WIDEN_AFTER ищут пару в соседних
+    шардах. Поиск у соседей тоже считается в потоке по снимку: не больше
+    widen_limit ожидающих за раунд, а тому, кому пары не нашлось, пауза
+    до следующей попытки удваивается (до SHARD_WIDEN_BACKOFF_MAX).
+    """
+
+    def __init__(self, cell_size: float = SHARD_CELL_SIZE, widen_after: float = SHARD_WIDEN_AFTER,
+                 recent: Optional[RecentPartners] = None, widen_limit: int = SHARD_WIDEN_LIMIT):
+        self.cell_size = cell_size
+        self.widen_after = widen_after
+        self.widen_limit = widen_limit
+        self.recent = recent
+        self._shards: Dict[Tuple[int, int], MatchQueue] = {}
+        self._locks: Dict[Tuple[int, int], asyncio.Lock] = {}
+        # user_id -> ключ шарда
+        self._shard_of: Dict[int, Tuple[int, int]] = {}
+        # user_id -> (время следующей попытки у соседей, текущая пауза)
+        self._widen_backoff: Dict[int, Tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._shard_of)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._shard_of
+
+    def __iter__(self) -> Iterator[Waiter]:
+        for shard in list(self._shards.values()):
+            yield from shard
+
+    @property
+    def shard_count(self) -> int:
+        return len(self._shards)
+
+    def get(self, user_id: int) -> Optional[Waiter]:
+        shard_key = self._shard_of.get(user_id)
+        return self._shards[shard_key].get(user_id) if shard_key else None
+
+    def add(self, waiter: Waiter) -> bool:
+        """Добавить пользователя в шард его региона"""
+        if waiter.user_id in self._shard_of:
+            return False
+        shard_key = _grid_cell(waiter.lat, waiter.lng, self.cell_size)
+        shard = self._shards.get(shard_key)
+        if shard is None:
+            shard = self._shards[shard_key] = MatchQueue(self.recent)
+            self._locks[shard_key] = asyncio.Lock()
+        try:
+            shard.add(waiter)
+        finally:
+            # Не оставляем пустой шард, если добавить не удалось
+            if not shard and not self._locks[shard_key].locked():
+                del self._shards[shard_key]
+                del self._locks[shard_key]
+        # Шард пользователя запоминаем только после успешного добавления
+        self._shard_of[waiter.user_id] = shard_key
+        return True
+
+    def remove(self, user_id: int) -> Optional[Waiter]:
+        """Удалить пользователя из очереди"""
+        shard_key = self._shard_of.pop(user_id, None)
+        if shard_key is None:
+            return None
+        self._widen_backoff.pop(user_id, None)
+        shard = self._shards[shard_key]
+        waiter = shard.remove(user_id)
+        # Пустой шард не удаляем, пока по нему идет раунд
+        if not shard and not self._locks[shard_key].locked():
+            del self._shards[shard_key]
+            del self._locks[shard_key]
+        return waiter
+
+    def _forget(self, pairs: List[Tuple[Waiter, Waiter]]):
+        """Снять пользователей из пар, уже удаленных из шарда"""
+        for user1, user2 in pairs:
+            for user_id in (user1.user_id, user2.user_id):
+                self._shard_of.pop(user_id, None)
+                self._widen_backoff.pop(user_id, None)
+
+    async def _pair_shard(self, shard_key: Tuple[int, int]) -> List[Tuple[Waiter, Waiter]]:
+        # Шард мог опустеть и удалиться, пока задача раунда ждала запуска
+        shard = self._shards.get(shard_key)
+        if shard is None:
+            return []
+        async with self._locks[shard_key]:
+            snapshots = shard.snapshot()
+            id_pairs = await asyncio.to_thread(pair_chunks, snapshots, self.recent)
+            pairs = shard.take_pairs(id_pairs)
+        self._forget(pairs)
+        if not shard and self._shards.get(shard_key) is shard:
+            del self._shards[shard_key]
+            del self._locks[shard_key]
+        return pairs
+
+    def _widen_tasks(self) -> List[Tuple[PoolSnapshot, PoolSnapshot]]:
+        """Снимки для поиска у соседей: (долго ждущие шарда, все ожидающие соседних шардов)"""
+        now = time.monotonic()
+        cutoff = now - self.widen_after
+        budget = self.widen_limit
+        neighbor_snapshots: Dict[Tuple[int, int], PoolSnapshot] = {}
+        tasks = []
+        for shard_key, shard in list(self._shards.items()):
+            if budget <= 0:
+                break
+            neighbor_keys = [key for key in _ring(shard_key[0], shard_key[1], 1) if key in self._shards]
+            if not neighbor_keys:
+                continue
+            due = []
+            for user_id in shard.waiting_since(cutoff):
+                next_at, _ = self._widen_backoff.get(user_id, (0.0, 0.0))
+                if next_at <= now:
+                    due.append(user_id)
+                    if len(due) >= budget:
+                        break
+            if not due:
+                continue
+            budget -= len(due)
+            for user_id in due:
+                # Удачная попытка уберет пользователя из очереди вместе с паузой
+                _, delay = self._widen_backoff.get(user_id, (0.0, WIDEN_BACKOFF_START / 2))
+                delay = min(delay * 2, SHARD_WIDEN_BACKOFF_MAX)
+                self._widen_backoff[user_id] = (now + delay, delay)
+            for key in neighbor_keys:
+                if key not in neighbor_snapshots:
+                    neighbor_snapshots[key] = self._shards[key].snapshot_all()
+            tasks.append((
+                shard.snapshot_of(due),
+                concat_snapshots([neighbor_snapshots[key] for key in neighbor_keys])
+            ))
+        return tasks
+
+    def _take(self, id_pairs: List[Tuple[int, int]]) -> List[Tuple[Waiter, Waiter]]:
+        """Забрать пары, посчитанные по снимку, если оба еще в очереди"""
+        pairs = []
+        for user1_id, user2_id in id_pairs:
+            if user1_id in self._shard_of and user2_id in self._shard_of:
+                pairs.append((self.remove(user1_id), self.remove(user2_id)))
+        return pairs
+
+    async def pair_round(self) -> List[Tuple[Waiter, Waiter]]:
+        """Раунд подбора: параллельно по шардам, затем расширение на соседей"""
+        if self.recent is not None:
+            self.recent.rotate_if_due()
+        busy = [key for key, shard in self._shards.items() if len(shard) >= 2 and not self._locks[key].locked()]
+        # Ошибка одного шарда не должна терять пары, уже забранные из других
+        results = await asyncio.gather(*(self._pair_shard(key) for key in busy), return_exceptions=True)
+        pairs = []
+        for key, result in zip(busy, results):
+            if isinstance(result, BaseException):
+                print(f"Shard {key} round error: {result!r}")
+                continue
+            pairs.extend(result)
+        tasks = self._widen_tasks()
+        if tasks:
+            id_pairs = await asyncio.to_thread(widen_chunks, tasks, self.recent)
+            pairs.extend(self._take(id_pairs))
+        return pairs
@@ -1,70 +1,238 @@
-from geopy.distance import geodesic
-from sqlalchemy.orm import Session
-from models import User
-import random
-
-class MatchMaker:
-    def __init__(self):
-        self.waiting_users = []
-    
-    def add_waiting_user(self, user_id: int, gender: str, age: int, lat: float, lng: float):
-        """Добавить пользователя в очередь поиска"""
-        user_data = {
-            'user_id': user_id,
-            'gender': gender,
-            'age': age,
-            'location': (lat, lng),
-            'timestamp': None
-        }
-        self.waiting_users.append(user_data)
-    
-    def remove_waiting_user(self, user_id: int):
-        """Удалить пользователя из очереди"""
-        self.waiting_users = [u for u in self.waiting_users if u['user_id'] != user_id]
-    
-    def find_match(self, current_user_id: int, db: Session):
-        """Найти подходящего собеседника"""
-        current_user_data = next((u for u in self.waiting_users if u['user_id'] == current_user_id), None)
-        if not current_user_data:
-            return None
-        
-        current_user = db.query(User).filter(User.id == current_user_id).first()
-        if not current_user:
-            return None
-        
-        # Фильтруем подходящих кандидатов
-        candidates = []
-        for candidate in self.waiting_users:
-            if candidate['user_id'] == current_user_id:
-                continue
-            
-            candidate_user = db.query(User).filter(User.id == candidate['user_id']).first()
-            if not candidate_user:
-                continue
-            
-            # Проверяем противоположный пол
-            if candidate['gender'] == current_user_data['gender']:
-                continue
-            
-            # Проверяем разницу в возрасте (максимум 5 лет)
-            age_diff = abs(candidate['age'] - current_user_data['age'])
-            if age_diff > 5:
-                continue
-            
-            # Рассчитываем расстояние
-            distance = geodesic(current_user_data['location'], candidate['location']).kilometers
-            
-            candidates.append({
-                'user_id': candidate['user_id'],
-                'distance': distance,
-                'age_diff': age_diff
-            })
-        
-        if not candidates:
-            return None
-        
-        # Сортируем по расстоянию и разнице в возрасте
-        candidates.sort(key=lambda x: (x['distance'], x['age_diff']))
-        
-        # Возвращаем лучшего кандидата
-        return candidates[0]['user_id']
\ No newline at end of file
+import math
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Максимальная разница в возрасте для матча
+MAX_AGE_DIFF = 10
+# Допустимые значения пола (как в формах static/index.html)
+GENDERS = ('male', 'female')
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Штраф за год разницы: прежние 5 "градусов" расстояния
+AGE_PENALTY_KM = 5 * KM_PER_DEGREE
+
+# Коды полов общие для всех пулов, чтобы снимки разных шардов были совместимы
+_gender_codes: Dict[str, int] = {}
+_gender_names: List[str] = []
+
+
+def gender_code(gender: str) -> int:
+    code = _gender_codes.get(gender)
+    if code is None:
+        code = _gender_codes[gender] = len(_gender_names)
+        _gender_names.append(gender)
+    return code
+
+
+def gender_name(code: int) -> str:
+    return _gender_names[code]
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Расстояние по большому кругу (км); работает и с массивами NumPy"""
+    lat1, lng1, lat2, lng2 = np.radians(lat1), np.radians(lng1), np.radians(lat2), np.radians(lng2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class PoolSnapshot:
+    """Копия части пула для расчета вне цикла событий"""
+
+    __slots__ = ('ids', 'lat', 'lng', 'age', 'gender')
+
+    def __init__(self, ids, lat, lng, age, gender):
+        self.ids = ids
+        self.lat = lat
+        self.lng = lng
+        self.age = age
+        self.gender = gender
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index: slice) -> 'PoolSnapshot':
+        return PoolSnapshot(self.ids[index], self.lat[index], self.lng[index], self.age[index], self.gender[index])
+
+
+def concat_snapshots(snapshots: List[PoolSnapshot]) -> PoolSnapshot:
+    """Один снимок из нескольких"""
+    return PoolSnapshot(*(
+        np.concatenate([getattr(snapshot, name) for snapshot in snapshots])
+        for name in PoolSnapshot.__slots__
+    ))
+
+
+class ScoringPool:
+    """Ожидающие в непрерывных массивах NumPy (lat, lng, age, код пола,
+    время постановки в очередь).
+
+    Добавление - в конец с удвоением емкости, удаление - перестановкой
+    последнего элемента на место удаляемого. Score считается векторно
+    по снимкам (cross_cost).
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.lat = np.empty(capacity, dtype=np.float64)
+        self.lng = np.empty(capacity, dtype=np.float64)
+        self.age = np.empty(capacity, dtype=np.int16)
+        self.gender = np.empty(capacity, dtype=np.int16)
+        self.enqueued_at = np.empty(capacity, dtype=np.float64)
+        self._slots: Dict[int, int] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._slots
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+        for name in ('ids', 'lat', 'lng', 'age', 'gender', 'enqueued_at'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def slot(self, user_id: int) -> Optional[int]:
+        return self._slots.get(user_id)
+
+    def append(self, user_id: int, gender: str, age: int, lat: float, lng: float, enqueued_at: float = 0.0):
+        if user_id in self._slots:
+            return
+        if self._size == len(self.ids):
+            self._grow()
+        slot = self._size
+        self.ids[slot] = user_id
+        self.lat[slot] = lat
+        self.lng[slot] = lng
+        self.age[slot] = age
+        self.gender[slot] = gender_code(gender)
+        self.enqueued_at[slot] = enqueued_at
+        self._slots[user_id] = slot
+        self._size += 1
+
+    def remove(self, user_id: int) -> bool:
+        slot = self._slots.pop(user_id, None)
+        if slot is None:
+            return False
+        last = self._size - 1
+        if slot != last:
+            moved_id = int(self.ids[last])
+            for array in (self.ids, self.lat, self.lng, self.age, self.gender, self.enqueued_at):
+                array[slot] = array[last]
+            self._slots[moved_id] = slot
+        self._size = last
+        return True
+
+    def slots_since(self, cutoff: float = math.inf) -> np.ndarray:
+        """Слоты вставших в очередь раньше cutoff, от самых давних"""
+        enqueued_at = self.enqueued_at[:self._size]
+        slots = np.flatnonzero(enqueued_at < cutoff)
+        return slots[np.argsort(enqueued_at[slots], kind='stable')]
+
+    def snapshot_slots(self, slots: np.ndarray) -> PoolSnapshot:
+        """Копия данных в указанных слотах"""
+        return PoolSnapshot(self.ids[slots], self.lat[slots], self.lng[slots], self.age[slots], self.gender[slots])
+
+    def snapshot(self, user_ids: List[int]) -> PoolSnapshot:
+        """Копия данных указанных пользователей"""
+        slots = np.fromiter((self._slots[user_id] for user_id in user_ids), dtype=np.int64, count=len(user_ids))
+        return self.snapshot_slots(slots)
+
+    def snapshot_all(self) -> PoolSnapshot:
+        """Копия всего пула (в порядке слотов)"""
+        n = self._size
+        return PoolSnapshot(self.ids[:n].copy(), self.lat[:n].copy(), self.lng[:n].copy(),
+                            self.age[:n].copy(), self.gender[:n].copy())
+
+
+def cross_cost(left: PoolSnapshot, right: PoolSnapshot) -> np.ndarray:
+    """Score каждой пары (left[i], right[j]); inf для неподходящих"""
+    age_diff = np.abs(left.age.astype(np.float32)[:, None] - right.age.astype(np.float32)[None, :])
+    cost = haversine_km(
+        left.lat.astype(np.float32)[:, None], left.lng.astype(np.float32)[:, None],
+        right.lat.astype(np.float32)[None, :], right.lng.astype(np.float32)[None, :]
+    )
+    cost += age_diff * np.float32(AGE_PENALTY_KM)
+    cost[(left.gender[:, None] == right.gender[None, :]) | (age_diff > MAX_AGE_DIFF)] = np.inf
+    return cost
+
+
+def cost_matrix(snapshot: PoolSnapshot) -> np.ndarray:
+    """Попарные score снимка; inf для неподходящих пар и диагонали"""
+    return cross_cost(snapshot, snapshot)
+
+
+def assign_pairs(snapshot: PoolSnapshot, candidates_per_user: int, recent=None) -> List[Tuple[int, int]]:
+    """Глобальное жадное назначение пар по матрице стоимости.
+
+    Для каждого пользователя остаются только его лучшие кандидаты, затем
+    рёбра перебираются по возрастанию score. Рёбра недавних собеседников
+    (recent - RecentPartners) отбрасываются. Возвращает пары user_id.
+    """
+    n = len(snapshot)
+    if n < 2:
+        return []
+
+    cost = cost_matrix(snapshot)
+    k = min(candidates_per_user, n - 1)
+    rows = np.repeat(np.arange(n), k)
+    cols = np.argpartition(cost, k - 1, axis=1)[:, :k].ravel()
+    edge_cost = cost[rows, cols]
+    finite = np.isfinite(edge_cost)
+    rows, cols, edge_cost = rows[finite], cols[finite], edge_cost[finite]
+    if recent is not None and len(recent):
+        fresh = ~recent.contains(snapshot.ids[rows], snapshot.ids[cols])
+        rows, cols, edge_cost = rows[fresh], cols[fresh], edge_cost[fresh]
+
+    taken = np.zeros(n, dtype=bool)
+    pairs = []
+    for edge in np.argsort(edge_cost, kind='stable'):
+        i, j = rows[edge], cols[edge]
+        if taken[i] or taken[j]:
+            continue
+        taken[i] = taken[j] = True
+        pairs.append((int(snapshot.ids[i]), int(snapshot.ids[j])))
+    return pairs
+
+
+def assign_across(left: PoolSnapshot, right: PoolSnapshot, candidates_per_user: int,
+                  recent=None, taken: Optional[Set[int]] = None) -> List[Tuple[int, int]]:
+    """Жадное назначение пар между двумя снимками (left - ищущие, right - кандидаты).
+
+    Матрица стоимости считается блоками строк, чтобы память не росла с
+    размером right. taken - user_id, уже занятые в этом раунде; дополняется.
+    """
+    if not len(left) or not len(right):
+        return []
+    taken = set() if taken is None else taken
+    k = min(candidates_per_user, len(right))
+    block = max(1, 1_000_000 // len(right))
+
+    rows, cols, edge_cost = [], [], []
+    for start in range(0, len(left), block):
+        cost = cross_cost(left[start:start + block], right)
+        best = np.argpartition(cost, k - 1, axis=1)[:, :k]
+        local_rows = np.repeat(np.arange(len(cost)), k)
+        rows.append(local_rows + start)
+        cols.append(best.ravel())
+        edge_cost.append(cost[local_rows, best.ravel()])
+    rows, cols, edge_cost = np.concatenate(rows), np.concatenate(cols), np.concatenate(edge_cost)
+    finite = np.isfinite(edge_cost)
+    rows, cols, edge_cost = rows[finite], cols[finite], edge_cost[finite]
+    if recent is not None and len(recent):
+        fresh = ~recent.contains(left.ids[rows], right.ids[cols])
+        rows, cols, edge_cost = rows[fresh], cols[fresh], edge_cost[fresh]
+
+    pairs = []
+    for edge in np.argsort(edge_cost, kind='stable'):
+        user1_id, user2_id = int(left.ids[rows[edge]]), int(right.ids[cols[edge]])
+        if user1_id in taken or user2_id in taken:
+            continue
+        taken.add(user1_id)
+        taken.add(user2_id)
+        pairs.append((user1_id, user2_id))
+    return pairs
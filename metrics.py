@@ -0,0 +1,205 @@
+"""Метрики в текстовом формате Prometheus без внешних зависимостей.
+
+Гистограммы с фиксированными границами считаются по месту (bisect и
+инкремент), gauge читаются функцией в момент запроса /metrics - на
+горячем пути нет ни аллокаций, ни форматирования.
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Границы по умолчанию (секунды): от 100 мкс до 10 с
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Глубина исходящей очереди соединения (кадры)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+# Время ожидания пары (секунды)
+WAIT_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _HistogramSeries:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Гистограмма с метками; observe можно вызывать из любого потока"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], _HistogramSeries] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series.setdefault(labels, _HistogramSeries(len(self.buckets) + 1))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series.counts[index] += 1
+            series.sum += value
+            series.count += 1
+
+    def time(self, *labels: str) -> '_Timer':
+        """Контекстный менеджер: записать длительность блока"""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self._series.items()):
+            with self._lock:
+                counts, total, count = list(series.counts), series.sum, series.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                label_text = _format_labels(self.label_names, labels, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{label_text} {cumulative}')
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """Значение, которое читается функцией в момент сбора метрик"""
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {_format_value(self.read())}'
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"Metric {metric.name} render error: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+# Глобальный реестр и метрики горячих путей
+registry = Registry()
+
+DB_QUERY_SECONDS = registry.histogram(
+    'chatminute_db_query_seconds', 'Время выполнения метода Database', ('method',)
+)
+MATCH_WAIT_SECONDS = registry.histogram(
+    'chatminute_match_wait_seconds', 'Время от начала поиска до найденной пары', buckets=WAIT_BUCKETS
+)
+MATCH_ROUND_SECONDS = registry.histogram(
+    'chatminute_match_round_seconds', 'Длительность раунда подбора пар'
+)
+MATCH_WIDEN_SECONDS = registry.histogram(
+    'chatminute_match_widen_seconds', 'Подбор пар у соседних шардов (в потоке)'
+)
+WS_MESSAGE_SECONDS = registry.histogram(
+    'chatminute_ws_message_seconds', 'Время обработки сообщения WebSocket', ('type',)
+)
+SIGNAL_FANOUT_SECONDS = registry.histogram(
+    'chatminute_signal_fanout_seconds', 'Время пересылки WebRTC сигнала собеседнику', ('signal',)
+)
+MATCHES_TOTAL = registry.counter(
+    'chatminute_matches_total', 'Созданные сессии матча'
+)
+REPEAT_PAIRS_SKIPPED = registry.counter(
+    'chatminute_repeat_pairs_skipped_total', 'Кандидаты, отсеянные как недавние собеседники'
+)
+OUTBOUND_QUEUE_DEPTH = registry.histogram(
+    'chatminute_outbound_queue_depth', 'Глубина исходящей очереди соединения после добавления кадра', buckets=DEPTH_BUCKETS
+)
+OUTBOUND_DROPPED = registry.counter(
+    'chatminute_outbound_dropped_total', 'Кадры, выброшенные из переполненной очереди', ('type',)
+)
+OUTBOUND_EVICTIONS = registry.counter(
+    'chatminute_outbound_evictions_total', 'Медленные клиенты, отключенные из-за переполнения очереди'
+)
+HEARTBEAT_EVICTIONS = registry.counter(
+    'chatminute_heartbeat_evictions_total', 'Соединения, отключенные из-за отсутствия ответа на ping'
+)
+SIGNALS_TOTAL = registry.counter(
+    'chatminute_signals_total', 'WebRTC сигналы по результату пересылки', ('signal', 'result')
+)
@@ -0,0 +1,216 @@
+"""Версионные миграции схемы SQLite и проверка планов запросов.
+
+Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+одной транзакцией вместе с повышением версии, так что ее можно безопасно
+запускать при каждом старте и из нескольких воркеров сразу.
+
+Проверка планов: python migrations.py check
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+from typing import List, Set, Tuple
+
+# (версия, DDL) по возрастанию версии; уже выпущенные миграции не меняются
+MIGRATIONS: List[Tuple[int, List[str]]] = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE,
+            password_hash TEXT NOT NULL,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            bio TEXT,
+            interests TEXT,
+            location_lat REAL DEFAULT 55.7558,
+            location_lng REAL DEFAULT 37.6173,
+            is_online BOOLEAN DEFAULT FALSE,
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS match_sessions (
+            id TEXT PRIMARY KEY,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            room_id TEXT UNIQUE NOT NULL,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            user1_approval BOOLEAN,
+            user2_approval BOOLEAN,
+            is_matched BOOLEAN DEFAULT FALSE,
+            ended_at DATETIME,
+            FOREIGN KEY (user1_id) REFERENCES users (id),
+            FOREIGN KEY (user2_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS connections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            matched_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE,
+            FOREIGN KEY (user1_id) REFERENCES users (id),
+            FOREIGN KEY (user2_id) REFERENCES users (id)
+        )
+        ''',
+    ]),
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_users_online ON users (is_online)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_ended ON match_sessions (ended_at)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user1 ON match_sessions (user1_id, started_at)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user2 ON match_sessions (user2_id, started_at)',
+        'CREATE INDEX IF NOT EXISTS idx_connections_users ON connections (user1_id, user2_id)',
+        'CREATE INDEX IF NOT EXISTS idx_connections_user2 ON connections (user2_id)',
+    ]),
+    (3, [
+        # Покрывающие индексы для постраничной истории: порядок (время, id)
+        # внутри пользователя и все выбираемые колонки без обращения к таблице
+        'DROP INDEX IF EXISTS idx_sessions_user1',
+        'DROP INDEX IF EXISTS idx_sessions_user2',
+        'DROP INDEX IF EXISTS idx_connections_user2',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user1_history '
+        'ON match_sessions (user1_id, started_at, id, user2_id, ended_at, is_matched)',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_user2_history '
+        'ON match_sessions (user2_id, started_at, id, user1_id, ended_at, is_matched)',
+        'CREATE INDEX IF NOT EXISTS idx_connections_user1_history '
+        'ON connections (user1_id, matched_at, id, user2_id, is_active)',
+        'CREATE INDEX IF NOT EXISTS idx_connections_user2_history '
+        'ON connections (user2_id, matched_at, id, user1_id, is_active)',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применить недостающие миграции. Возвращает итоговую версию схемы"""
+    for version, statements in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        # IMMEDIATE сразу берет блокировку записи: версию перечитываем под ней,
+        # чтобы параллельно стартующие воркеры не применили миграцию дважды
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            applied = version > schema_version(conn)
+            if applied:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if applied:
+            print(f"Database schema migrated to version {version}")
+    return schema_version(conn)
+
+
+# Запросы, которые сканируют таблицу целиком намеренно: (метод, таблица)
+FULL_SCAN_ALLOWED: Set[Tuple[str, str]] = {
+    # Итоговые COUNT(*) - раз в STATS_RECONCILE_INTERVAL
+    ('get_totals', 'users'),
+    ('get_totals', 'connections'),
+}
+
+
+def _exercise(database) -> None:
+    """Вызвать каждый метод Database с тестовыми данными"""
+    user1 = database.create_user({
+        'username': 'plan1', 'email': 'plan1@example.com', 'password_hash': 'x',
+        'first_name': 'A', 'last_name': 'B', 'age': 30, 'gender': 'male'
+    })
+    user2 = database.create_user({
+        'username': 'plan2', 'email': 'plan2@example.com', 'password_hash': 'x',
+        'first_name': 'C', 'last_name': 'D', 'age': 28, 'gender': 'female'
+    })
+    database.user_cache.invalidate(user1)
+    database.get_user_by_id(user1)
+    database.get_user_by_username('plan1')
+    database.get_user_by_email('plan1@example.com')
+    database.update_user(user1, {'bio': 'plan'})
+    database.update_users_online_status([(True, '2024-01-01 00:00:00', user2)])
+    database.reset_online_status()
+    database.save_match_session({
+        'id': 'session-2', 'user1_id': user1, 'user2_id': user2, 'room_id': 'room-2',
+        'started_at': '2024-01-01 00:00:00', 'user1_approval': None, 'user2_approval': None,
+        'is_matched': False, 'ended_at': '2024-01-01 00:01:00'
+    })
+    database.create_connection(user1, user2)
+    database.get_connections_page(user1, None, 20)
+    database.get_connections_page(user2, ('2024-01-01 00:00:00', 1), 20)
+    database.get_history_page(user1, None, 20)
+    database.get_history_page(user2, ('2024-01-01 00:00:00', 'session-2'), 20)
+    database.get_recent_pairs(1800)
+    database.get_totals()
+
+
+def check_query_plans() -> List[str]:
+    """EXPLAIN QUERY PLAN для каждого запроса Database; список полных сканирований"""
+    from database import Database
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database = Database(os.path.join(workdir, 'plans.db'))
+        conn = database.get_connection()
+
+        # Запросы перехватываются трассировкой с подставленными параметрами
+        captured: List[Tuple[str, str]] = []
+        current = {'method': None}
+        conn.set_trace_callback(lambda sql: captured.append((current['method'], sql)))
+
+        for name in dir(database):
+            method = getattr(database, name)
+            if name.startswith('_') or not callable(method):
+                continue
+            setattr(database, name, _traced(method, name, current))
+        _exercise(database)
+        conn.set_trace_callback(None)
+
+        problems = []
+        for method, sql in captured:
+            statement = sql.strip()
+            if not statement.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT'):
+                continue
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {statement}')]
+            for step in plan:
+                words = step.split()
+                # SCAN CONSTANT ROW и SCAN (subquery-N) - обход уже отобранных строк, не таблицы
+                table = words[1] if len(words) > 1 else ''
+                if words[0] != 'SCAN' or table == 'CONSTANT' or table.startswith('('):
+                    continue
+                if (method, table) not in FULL_SCAN_ALLOWED:
+                    problems.append(f"{method}: {step}\n    {' '.join(statement.split())}")
+        database.close()
+    return problems
+
+
+def _traced(method, name: str, current: dict):
+    def call(*args, **kwargs):
+        outer, current['method'] = current['method'], current['method'] or name
+        try:
+            return method(*args, **kwargs)
+        finally:
+            current['method'] = outer
+    return call
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ['check']:
+        print(__doc__)
+        sys.exit(2)
+    problems = check_query_plans()
+    for problem in problems:
+        print(f"FULL SCAN in {problem}")
+    print("OK: no unexpected full table scans" if not problems else f"{len(problems)} full table scan(s)")
+    sys.exit(1 if problems else 0)
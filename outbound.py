@@ -0,0 +1,75 @@
+import asyncio
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from config import OUTBOUND_QUEUE_SIZE, OUTBOUND_OVERFLOW_POLICY
+from metrics import OUTBOUND_QUEUE_DEPTH, OUTBOUND_DROPPED
+
+# Кадры, которые можно выбросить при переполнении: устаревший ICE кандидат
+# или статистика хуже, чем разрыв соединения
+DROPPABLE_FRAMES = {"ice_candidates", "stats"}
+# Кадры, из которых в очереди нужен только последний
+COALESCED_FRAMES = {"stats"}
+
+# Политики переполнения
+DROP_STALE = "drop_stale"
+DISCONNECT = "disconnect"
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих кадров одного соединения.
+
+    Кадры добавляет любой обработчик без ожидания, отправляет их отдельная
+    задача-писатель. При переполнении политика drop_stale выбрасывает самый
+    старый необязательный кадр (ICE кандидат, статистику), а если таких нет -
+    сообщает о медленном клиенте; политика disconnect сообщает сразу.
+    """
+
+    __slots__ = ('_frames', '_ready', 'maxsize', 'policy', 'dropped')
+
+    def __init__(self, maxsize: int = OUTBOUND_QUEUE_SIZE, policy: str = OUTBOUND_OVERFLOW_POLICY):
+        # (тип сообщения, сериализованный кадр)
+        self._frames: Deque[Tuple[Optional[str], str]] = deque()
+        self._ready = asyncio.Event()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def _drop_stale(self) -> Optional[str]:
+        for index, (kind, _) in enumerate(self._frames):
+            if kind in DROPPABLE_FRAMES:
+                del self._frames[index]
+                self.dropped += 1
+                OUTBOUND_DROPPED.inc(kind)
+                return kind
+        return None
+
+    def push(self, frame: str, kind: Optional[str] = None) -> bool:
+        """Добавить кадр. False - клиент не успевает, его нужно отключить"""
+        if kind in COALESCED_FRAMES:
+            for index, (queued_kind, _) in enumerate(self._frames):
+                if queued_kind == kind:
+                    self._frames[index] = (kind, frame)
+                    return True
+
+        if len(self._frames) >= self.maxsize:
+            if self.policy != DROP_STALE or self._drop_stale() is None:
+                return False
+
+        self._frames.append((kind, frame))
+        self._ready.set()
+        OUTBOUND_QUEUE_DEPTH.observe(len(self._frames))
+        return True
+
+    async def pop(self) -> str:
+        """Дождаться и забрать следующий кадр"""
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._frames.popleft()[1]
+
+    def clear(self):
+        self._frames.clear()
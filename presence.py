@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from config import PRESENCE_FLUSH_INTERVAL
+
+
+class PresenceTracker:
+    """Онлайн-статус пользователей в памяти с отложенной записью в БД.
+
+    Источник истины - множество online. Изменения копятся в pending и
+    сбрасываются фоновой задачей одной транзакцией; повторные изменения
+    одного пользователя между сбросами схлопываются в последнее.
+    """
+
+    def __init__(self):
+        self._online: Set[int] = set()
+        # user_id -> (is_online, last_seen)
+        self._pending: Dict[int, Tuple[bool, str]] = {}
+
+    @property
+    def online_count(self) -> int:
+        return len(self._online)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._online
+
+    def set_online(self, user_id: int, is_online: bool):
+        """Обновить статус пользователя"""
+        if is_online:
+            self._online.add(user_id)
+        else:
+            self._online.discard(user_id)
+        self._pending[user_id] = (is_online, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+
+    def drain(self) -> List[Tuple[bool, str, int]]:
+        """Забрать накопленные изменения в виде строк для executemany"""
+        pending, self._pending = self._pending, {}
+        return [(is_online, last_seen, user_id) for user_id, (is_online, last_seen) in pending.items()]
+
+    def restore(self, updates: List[Tuple[bool, str, int]]):
+        """Вернуть незаписанные изменения; более новые из pending не затираются"""
+        for is_online, last_seen, user_id in updates:
+            self._pending.setdefault(user_id, (is_online, last_seen))
+
+    async def flush(self, adb):
+        """Записать накопленные изменения в БД"""
+        updates = self.drain()
+        if not updates:
+            return
+        try:
+            await adb.update_users_online_status(updates)
+        except BaseException:
+            # Запишутся при следующем сбросе
+            self.restore(updates)
+            raise
+
+    async def run(self, adb, interval: float = PRESENCE_FLUSH_INTERVAL):
+        """Фоновая задача периодического сброса"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(adb)
+            except Exception as e:
+                print(f"Presence flush error: {e}")
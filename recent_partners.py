@@ -0,0 +1,110 @@
+import math
+import time
+
+import numpy as np
+
+from config import RECENT_PARTNER_CAPACITY, RECENT_PARTNER_FP_RATE, RECENT_PARTNER_TTL
+from metrics import REPEAT_PAIRS_SKIPPED
+
+# Константы splitmix64
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    x = x + _GOLDEN
+    x = (x ^ (x >> np.uint64(30))) * _MIX1
+    x = (x ^ (x >> np.uint64(27))) * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+class RecentPartners:
+    """Недавние пары собеседников: скользящий фильтр Блума из двух поколений.
+
+    Пара (без учета порядка) пишется в текущее поколение; каждые ttl / 2
+    секунд (или при заполнении до capacity) текущее становится прошлым, а
+    прошлое очищается. Пара помнится от ttl / 2 до ttl секунд. Память
+    фиксирована, проверка - O(1) на пару и векторная для массивов;
+    ложные срабатывания возможны с вероятностью около fp_rate.
+
+    Пишется только из цикла событий, читается и из потоков раунда: биты
+    только добавляются, а поколения заменяются новыми массивами.
+    """
+
+    def __init__(self, ttl: float = RECENT_PARTNER_TTL, capacity: int = RECENT_PARTNER_CAPACITY,
+                 fp_rate: float = RECENT_PARTNER_FP_RATE):
+        self.ttl = ttl
+        self.capacity = capacity
+        # Оптимальные размер и число хешей для capacity элементов и fp_rate
+        self.bits = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._steps = np.arange(self.hashes, dtype=np.uint64)
+        self._current = np.zeros((self.bits + 7) // 8, dtype=np.uint8)
+        self._previous = np.zeros_like(self._current)
+        self._counts = [0, 0]  # пары в текущем и прошлом поколениях
+        self._rotated_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return self._counts[0] + self._counts[1]
+
+    def _positions(self, user_ids, partner_ids) -> np.ndarray:
+        """Номера битов пары: shape (..., hashes)"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        partner_ids = np.asarray(partner_ids, dtype=np.int64)
+        low = np.minimum(user_ids, partner_ids).astype(np.uint64)
+        high = np.maximum(user_ids, partner_ids).astype(np.uint64)
+        h = _mix((low << np.uint64(32)) | high)
+        h1 = (h & np.uint64(0xFFFFFFFF))[..., None]
+        h2 = ((h >> np.uint64(32)) | np.uint64(1))[..., None]
+        return (h1 + self._steps * h2) % np.uint64(self.bits)
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = np.zeros_like(self._previous)
+        self._counts = [0, self._counts[0]]
+        self._rotated_at = time.monotonic()
+
+    def rotate_if_due(self):
+        if time.monotonic() - self._rotated_at >= self.ttl / 2:
+            self._rotate()
+
+    def add(self, user1_id: int, user2_id: int, age: float = 0.0):
+        """Запомнить пару; age - сколько секунд назад она встречалась (при загрузке из БД)"""
+        if age >= self.ttl:
+            return
+        self.rotate_if_due()
+        if age >= self.ttl / 2:
+            bits, generation = self._previous, 1
+        else:
+            if self._counts[0] >= self.capacity:
+                self._rotate()
+            bits, generation = self._current, 0
+        positions = self._positions([user1_id], [user2_id])[0]
+        np.bitwise_or.at(bits, (positions >> np.uint64(3)).astype(np.intp),
+                         np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8)))
+        self._counts[generation] += 1
+
+    def contains(self, user_ids, partner_ids) -> np.ndarray:
+        """Маска пар, встречавшихся недавно (массивы одинаковой формы)"""
+        current, previous = self._current, self._previous
+        positions = self._positions(user_ids, partner_ids)
+        index = (positions >> np.uint64(3)).astype(np.intp)
+        mask = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        seen = ((current[index] & mask) != 0).all(axis=-1) | ((previous[index] & mask) != 0).all(axis=-1)
+        skipped = int(np.count_nonzero(seen))
+        if skipped:
+            REPEAT_PAIRS_SKIPPED.inc(amount=skipped)
+        return seen
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._current.nbytes + self._previous.nbytes
+
+    def false_positive_rate(self) -> float:
+        """Оценка вероятности ложного срабатывания по заполненности битов"""
+        miss = 1.0
+        for bits in (self._current, self._previous):
+            fill = int(np.unpackbits(bits).sum()) / self.bits
+            miss *= 1.0 - fill ** self.hashes
+        return 1.0 - miss
@@ -0,0 +1,115 @@
+import uuid
+from datetime import datetime
+from typing import Dict, Optional
+
+# Состояния сессии
+ACTIVE = 'active'
+MATCHED = 'matched'
+REJECTED = 'rejected'
+EXPIRED = 'expired'
+
+
+def _timestamp() -> str:
+    """Время в формате CURRENT_TIMESTAMP SQLite"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class MatchSession:
+    """Активная сессия двух пользователей"""
+
+    __slots__ = (
+        'id', 'room_id', 'user1_id', 'user2_id', 'user1_approval', 'user2_approval',
+        'deadline', 'state', 'started_at', 'ended_at'
+    )
+
+    def __init__(self, session_id: str, room_id: str, user1_id: int, user2_id: int, deadline: float):
+        self.id = session_id
+        self.room_id = room_id
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.user1_approval = None
+        self.user2_approval = None
+        self.deadline = deadline
+        self.state = ACTIVE
+        self.started_at = _timestamp()
+        self.ended_at = None
+
+    def has_user(self, user_id: int) -> bool:
+        return user_id == self.user1_id or user_id == self.user2_id
+
+    def partner_of(self, user_id: int) -> int:
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+
+    def to_row(self) -> dict:
+        """Строка для таблицы match_sessions"""
+        return {
+            'id': self.id,
+            'user1_id': self.user1_id,
+            'user2_id': self.user2_id,
+            'room_id': self.room_id,
+            'started_at': self.started_at,
+            'user1_approval': self.user1_approval,
+            'user2_approval': self.user2_approval,
+            'is_matched': self.state == MATCHED,
+            'ended_at': self.ended_at
+        }
+
+
+class SessionRegistry:
+    """Активные сессии в памяти с индексами по room_id, id и участникам.
+
+    Все переходы состояний синхронные (без await), поэтому на цикле событий
+    они атомарны без блокировок.
+    """
+
+    def __init__(self):
+        self._by_id: Dict[str, MatchSession] = {}
+        self._by_room: Dict[str, MatchSession] = {}
+        self._by_user: Dict[int, MatchSession] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def create(self, user1_id: int, user2_id: int, deadline: float) -> MatchSession:
+        """Создать активную сессию"""
+        session = MatchSession(str(uuid.uuid4()), str(uuid.uuid4()), user1_id, user2_id, deadline)
+        self._by_id[session.id] = session
+        self._by_room[session.room_id] = session
+        self._by_user[user1_id] = session
+        self._by_user[user2_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[MatchSession]:
+        return self._by_id.get(session_id)
+
+    def get_by_room(self, room_id: str) -> Optional[MatchSession]:
+        return self._by_room.get(room_id)
+
+    def get_by_user(self, user_id: int) -> Optional[MatchSession]:
+        return self._by_user.get(user_id)
+
+    def approve(self, session: MatchSession, user_id: int) -> bool:
+        """Отметить одобрение. True, если теперь оно взаимное"""
+        if session.state != ACTIVE:
+            return False
+        if user_id == session.user1_id:
+            session.user1_approval = True
+        elif user_id == session.user2_id:
+            session.user2_approval = True
+        else:
+            return False
+        return bool(session.user1_approval and session.user2_approval)
+
+    def finish(self, session: MatchSession, state: str) -> bool:
+        """Завершить сессию. False, если она уже была завершена"""
+        if session.state != ACTIVE:
+            return False
+        session.state = state
+        session.ended_at = _timestamp()
+
+        del self._by_id[session.id]
+        del self._by_room[session.room_id]
+        for user_id in (session.user1_id, session.user2_id):
+            if self._by_user.get(user_id) is session:
+                del self._by_user[user_id]
+        return True
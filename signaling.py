@@ -0,0 +1,68 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from config import ICE_BATCH_WINDOW, SIGNAL_LOG_SAMPLE
+from frames import dumps
+
+# Сообщения клиента, которые пересылаются собеседнику как есть
+SIGNAL_MESSAGES = {"webrtc_offer", "webrtc_answer", "ice_candidate"}
+# Уведомления, после доставки которых меняется собеседник соединения
+ROOM_EVENTS = {"match_found", "match_rejected", "time_expired", "search_started"}
+
+# send(from_user_id, target_user_id, candidates)
+SendCandidates = Callable[[int, int, List[dict]], Awaitable[None]]
+
+
+def with_sender(raw: str, user_id: int) -> str:
+    """Добавить from_user_id в исходный JSON объект без повторной сериализации.
+
+    Ключ дописывается последним, поэтому подменить его из клиента нельзя.
+    """
+    return '%s,"from_user_id":%d}' % (raw[:raw.rindex('}')], user_id)
+
+
+class CandidateBatcher:
+    """Собирает ICE кандидаты одного направления за окно window в один кадр"""
+
+    def __init__(self, send: SendCandidates, window: float = ICE_BATCH_WINDOW):
+        self.send = send
+        self.window = window
+        # (от кого, кому) -> кандидаты
+        self._pending: Dict[Tuple[int, int], List[dict]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, from_user_id: int, target_user_id: int, candidate: dict):
+        key = (from_user_id, target_user_id)
+        batch = self._pending.get(key)
+        if batch is None:
+            self._pending[key] = [candidate]
+            asyncio.get_running_loop().call_later(
+                self.window, lambda: asyncio.create_task(self.flush(from_user_id, target_user_id))
+            )
+        else:
+            batch.append(candidate)
+
+    async def flush(self, from_user_id: int, target_user_id: int):
+        """Отправить накопленное сейчас (например, перед offer того же направления)"""
+        candidates = self._pending.pop((from_user_id, target_user_id), None)
+        if not candidates:
+            return
+        try:
+            await self.send(from_user_id, target_user_id, candidates)
+        except Exception as e:
+            print(f"Error sending ICE candidates to {target_user_id}: {e}")
+
+
+class SampledLog:
+    """Структурный лог, который пишет только каждое every-е событие"""
+
+    def __init__(self, every: int = SIGNAL_LOG_SAMPLE):
+        self.every = max(1, every)
+        self._seen: Dict[str, int] = {}
+
+    def __call__(self, event: str, **fields):
+        seen = self._seen[event] = self._seen.get(event, 0) + 1
+        if seen % self.every == 1 or self.every == 1:
+            print(dumps({"event": event, "seen": seen, **fields}))
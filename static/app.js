@@ -129,7 +129,6 @@ function showMainScreen() {
     userName.textContent = `${currentUser.first_name} ${currentUser.last_name}`;
     initializeWebSocket();
     loadUserProfile();
-    loadStats();
     
     // Тестируем TURN сервер при загрузке
     setTimeout(testTurnServer, 2000);
@@ -442,6 +441,8 @@ function initializeWebSocket() {
     ws.onopen = () => {
         console.log('✅ WebSocket connected');
         status.textContent = 'Подключено к серверу';
+        // Статистику присылает сервер при изменении
+        sendWebSocketMessage({ type: 'subscribe_stats' });
         setTimeout(() => {
             status.textContent = 'Готов к поиску собеседников';
         }, 2000);
@@ -449,6 +450,11 @@ function initializeWebSocket() {
     
     ws.onmessage = (event) => {
         const message = JSON.parse(event.data);
+        // Сервер проверяет, что соединение живо
+        if (message.type === 'ping') {
+            ws.send(JSON.stringify({ type: 'pong' }));
+            return;
+        }
         console.log('📨 WebSocket message:', message.type, message);
         handleWebSocketMessage(message);
     };
@@ -509,8 +515,12 @@ function handleWebSocketMessage(message) {
             handleWebRTCAnswer(message);
             break;
             
-        case 'ice_candidate':
-            handleICECandidate(message);
+        case 'ice_candidates':
+            handleICECandidates(message);
+            break;
+            
+        case 'stats':
+            renderStats(message.stats);
             break;
     }
 }
@@ -538,7 +548,7 @@ async function handleMatchFound(message) {
     }
     
     await startVideoCall();
-    startTimer();
+    startTimer(message.duration);
 }
 
 async function startVideoCall() {
@@ -934,7 +944,6 @@ async function handleMatchSuccess(message) {
     document.querySelector('.chat-controls-overlay').classList.add('matched');
     
     status.textContent = message.message;
-    loadStats();
     
     console.log('✅ Match successful! Video call continues...');
 }
@@ -961,8 +970,8 @@ function handleTimeExpired(message) {
     }, 1000);
 }
 
-function startTimer() {
-    timeLeft = 60;
+function startTimer(duration = 60) {
+    timeLeft = duration;
     updateTimerDisplay();
     
     clearInterval(timerInterval);
@@ -1122,10 +1131,14 @@ async function handleWebRTCAnswer(message) {
     }
 }
 
-async function handleICECandidate(message) {
-    if (peerConnection && message.candidate) {
+async function handleICECandidates(message) {
+    // Сервер склеивает кандидаты, пришедшие почти одновременно, в одно сообщение
+    if (!peerConnection || !message.candidates) return;
+    
+    for (const candidate of message.candidates) {
+        if (!candidate) continue;
         try {
-            await peerConnection.addIceCandidate(new RTCIceCandidate(message.candidate));
+            await peerConnection.addIceCandidate(new RTCIceCandidate(candidate));
             console.log('✅ ICE candidate добавлен');
         } catch (error) {
             console.error('❌ Error adding ICE candidate:', error);
@@ -1180,11 +1193,8 @@ function getGenderText(gender) {
     return genders[gender] || gender;
 }
 
-async function loadStats() {
+function renderStats(stats) {
     try {
-        const response = await fetch('/api/stats');
-        const stats = await response.json();
-        
         statsInfo.innerHTML = `
             <div class="stats-grid">
                 <div class="stat-item">
@@ -1206,7 +1216,7 @@ async function loadStats() {
             </div>
         `;
     } catch (error) {
-        console.error('Error loading stats:', error);
+        console.error('Error rendering stats:', error);
     }
 }
 
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from typing import Callable, Dict, Tuple
+
+from config import STATS_RECONCILE_INTERVAL, STATS_WORKER_TTL
+from frames import dumps
+
+
+class AppStats:
+    """Статистика приложения из счетчиков в памяти.
+
+    Итоги по таблицам (пользователи, связи) увеличиваются при создании
+    записей и периодически сверяются с БД; текущие значения (онлайн,
+    сессии, очередь) читаются из структур в памяти и суммируются со
+    значениями, которые публикуют другие воркеры (сессии и очередь есть
+    только у координатора, у остальных они нулевые). Ответ и кадр для
+    WebSocket сериализуются заново только когда какое-то значение изменилось.
+    """
+
+    def __init__(self, worker_ttl: float = STATS_WORKER_TTL):
+        self.total_users = 0
+        self.total_matches = 0
+        self.worker_ttl = worker_ttl
+        # имя -> функция, читающая текущее значение
+        self._live: Dict[str, Callable[[], int]] = {}
+        # воркер -> (время получения, его текущие значения)
+        self._workers: Dict[str, Tuple[float, Dict[str, int]]] = {}
+        self._values: Tuple[int, ...] = ()
+        self._etag = ''
+        self._body = b''
+        self._frame = ''
+
+    def track(self, name: str, read: Callable[[], int]):
+        """Добавить значение, которое читается из памяти при запросе"""
+        self._live[name] = read
+
+    def user_created(self):
+        self.total_users += 1
+
+    def match_created(self):
+        self.total_matches += 1
+
+    def local_values(self) -> Dict[str, int]:
+        """Текущие значения этого воркера (для публикации остальным)"""
+        return {name: read() for name, read in self._live.items()}
+
+    def worker_values(self, worker: str, values: Dict[str, int]):
+        """Значения, опубликованные другим воркером"""
+        self._workers[worker] = (time.monotonic(), values)
+
+    def values(self) -> Dict[str, int]:
+        stats = {'total_users': self.total_users, 'total_matches': self.total_matches}
+        stats.update(self.local_values())
+        deadline = time.monotonic() - self.worker_ttl
+        for worker, (received_at, values) in list(self._workers.items()):
+            if received_at < deadline:
+                # Воркер остановлен или не может публиковать
+                del self._workers[worker]
+                continue
+            for name in self._live:
+                stats[name] += values.get(name, 0)
+        return stats
+
+    def snapshot(self) -> Tuple[str, bytes]:
+        """ETag и JSON текущей статистики"""
+        stats = self.values()
+        values = tuple(stats.values())
+        if values != self._values:
+            self._values = values
+            # ETag зависит только от значений: когда воркеры обменялись ими,
+            # он у всех одинаковый
+            self._etag = '"%s"' % '-'.join(map(str, values))
+            self._body = dumps(stats).encode()
+            self._frame = dumps({'type': 'stats', 'stats': stats})
+        return self._etag, self._body
+
+    def frame(self) -> Tuple[str, str]:
+        """ETag и готовое сообщение WebSocket со статистикой"""
+        etag, _ = self.snapshot()
+        return etag, self._frame
+
+    async def reconcile(self, adb):
+        """Сверить итоги с БД (учитывает записи других воркеров)"""
+        totals = await adb.get_totals()
+        self.total_users = totals['total_users']
+        self.total_matches = totals['total_matches']
+
+    async def run(self, adb, interval: float = STATS_RECONCILE_INTERVAL):
+        """Фоновая задача периодической сверки"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile(adb)
+            except Exception as e:
+                print(f"Stats reconcile error: {e}")
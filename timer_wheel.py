@@ -0,0 +1,78 @@
+import asyncio
+import math
+from typing import Any, Callable, Dict, Hashable, List
+
+from config import TIMER_TICK, TIMER_SLOTS
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров с одной управляющей задачей.
+
+    Таймер попадает в слот (текущий + число тиков) % slots; если задержка
+    длиннее одного оборота, в нем хранится число оставшихся оборотов.
+    Постановка и отмена - O(1), на каждом тике просматривается один слот.
+    """
+
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[Dict[Hashable, list]] = [{} for _ in range(slots)]
+        # key -> номер слота
+        self._timers: Dict[Hashable, int] = {}
+        self._current = 0
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable, *args: Any):
+        """Запустить callback(*args) через delay секунд (перезаписывает таймер с тем же key)"""
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._current + ticks) % self.slots
+        self._wheel[slot][key] = [(ticks - 1) // self.slots, callback, args]
+        self._timers[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        """Отменить таймер. False, если его нет"""
+        slot = self._timers.pop(key, None)
+        if slot is None:
+            return False
+        del self._wheel[slot][key]
+        return True
+
+    def advance(self):
+        """Сдвинуть колесо на один тик и запустить истекшие таймеры"""
+        self._current = (self._current + 1) % self.slots
+        bucket = self._wheel[self._current]
+        expired = []
+        for key, timer in bucket.items():
+            if timer[0]:
+                timer[0] -= 1
+            else:
+                expired.append(key)
+
+        fired = []
+        for key in expired:
+            fired.append(bucket.pop(key))
+            del self._timers[key]
+
+        for _, callback, args in fired:
+            try:
+                result = callback(*args)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+            except Exception as e:
+                print(f"Timer callback error: {e}")
+
+    async def run(self):
+        """Управляющая задача: тикает с постоянным шагом, догоняя пропущенные тики"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            while next_tick <= loop.time():
+                self.advance()
+                next_tick += self.tick